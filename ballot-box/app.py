@@ -1,16 +1,44 @@
+import csv
+import hmac
+import io
 import json
 import os
+import sys
 from typing import List
 
-from flask import Flask, request, render_template
+import click
+from flask import Flask, Response, abort, jsonify, make_response, request, render_template, stream_with_context
 from flask_babel import Babel
-from db import my_session_scope, MyDatabase, MyDatabaseSession, Poll, Vote, PollState, PollType, AnswerOption
+from ballot_writer import BallotNotWritten, BallotWriter
+from db import my_session_scope, MyDatabase, MyDatabaseSession, PollState, PollType, AnswerOption, ROW_ATTENDEE, \
+    ROW_TOKEN
+from metrics import instrument_app, instrument_engine
+from results_cache import create_results_cache
+from static_assets import StaticAssets
 
 app = Flask(__name__)
 
 babel = Babel(app)
 
-my_database = MyDatabase(os.getenv('DB_URL', 'sqlite:///./db.sqlite'))
+# Fingerprinted assets built by static_assets.py, templates link them with asset_url()
+static_assets = StaticAssets(app)
+
+# Ballots are committed in batches by a single writer per process if BALLOT_GROUP_COMMIT is set
+BALLOT_GROUP_COMMIT = os.getenv('BALLOT_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+
+my_database = MyDatabase(os.getenv('DB_URL', 'sqlite:///./db.sqlite'),
+                         poll_cache_size=int(os.getenv('POLL_CACHE_SIZE', '128')),
+                         sqlite_wal=BALLOT_GROUP_COMMIT)
+instrument_engine(my_database.db_engine)
+instrument_app(app)
+
+if BALLOT_GROUP_COMMIT:
+    ballot_writer = BallotWriter(my_database,
+                                 max_batch_size=int(os.getenv('BALLOT_GROUP_COMMIT_SIZE', '100')),
+                                 max_delay=float(os.getenv('BALLOT_GROUP_COMMIT_DELAY_MS', '20')) / 1000,
+                                 timeout=float(os.getenv('BALLOT_GROUP_COMMIT_TIMEOUT_MS', '30000')) / 1000)
+else:
+    ballot_writer = None
 
 EMPTY_VOTE = 'Leerer Stimmzettel'
 
@@ -21,6 +49,29 @@ app.config['LANGUAGES'] = [
     'fr'
 ]
 
+# Number of ballots and attendees shown per page of the poll results
+RESULTS_PAGE_SIZE = int(os.getenv('RESULTS_PAGE_SIZE', '200'))
+
+# Bearer token of the API used by vote-registration to activate polls, the API is disabled if it is not set
+BALLOT_BOX_API_TOKEN = os.getenv('BALLOT_BOX_API_TOKEN')
+
+# Number of polls shown per page of the admin overview
+ADMIN_OVERVIEW_PAGE_SIZE = int(os.getenv('ADMIN_OVERVIEW_PAGE_SIZE', '50'))
+
+# Result pages of closed polls are rendered once. Set RESULTS_CACHE_DIR to share them between the worker processes.
+results_cache = create_results_cache(os.getenv('RESULTS_CACHE_DIR'), int(os.getenv('RESULTS_CACHE_SIZE', '1000')))
+
+
+class Page:
+    def __init__(self, requested_page, total: int):
+        self.total = total
+        self.num_pages = max(1, (total + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE)
+        try:
+            self.number = min(max(1, int(requested_page)), self.num_pages)
+        except (TypeError, ValueError):
+            self.number = 1
+        self.offset = (self.number - 1) * RESULTS_PAGE_SIZE
+
 @app.route('/')
 def main():
     return render_template('message.html', state="no_poll_id")
@@ -28,47 +79,85 @@ def main():
 
 @app.route('/<poll_id>')
 def vote_form(poll_id):
+    # Only pages with valid page numbers are stored, so other values miss here and are clamped below
+    cached_results = results_cache.get(results_cache_key(poll_id, request.args.get('votes_page', '1'),
+                                                         request.args.get('attendees_page', '1')))
+    if cached_results is not None:
+        return results_response(*cached_results)
     with my_session_scope(my_database) as session:  # type: MyDatabaseSession
-        poll: Poll = session.get_poll_by_id(poll_id)
-        if poll.state == PollState.prepared:
-            return render_template('message.html', state="not_active", poll_label=poll.label, poll_id=poll_id)
-        elif poll.state == PollState.active:
-            return render_template('index.html', poll=poll)
+        poll_metadata = session.get_poll_metadata(poll_id)
+        if poll_metadata.state == PollState.prepared:
+            return render_template('message.html', state="not_active", poll_label=poll_metadata.label,
+                                   poll_id=poll_id)
+        elif poll_metadata.state == PollState.active:
+            return render_template('index.html', poll=poll_metadata)
         else:
             poll_results = session.get_results(poll_id)
-            return render_template('poll_results.html', poll=poll, poll_results=poll_results)
+            votes_page = Page(request.args.get('votes_page'), session.count_votes(poll_id))
+            attendees_page = Page(request.args.get('attendees_page'), session.count_attendees(poll_id))
+            cache_key = results_cache_key(poll_id, votes_page.number, attendees_page.number)
+            cached_results = results_cache.get(cache_key)
+            if cached_results is not None:
+                return results_response(*cached_results)
+            ballots = session.get_ballots(poll_id, [option.answer_id for option in poll_results],
+                                          votes_page.offset, RESULTS_PAGE_SIZE)
+            attendees = session.get_attendee_names(poll_id, attendees_page.offset, RESULTS_PAGE_SIZE)
+            body = render_template('poll_results.html', poll=poll_metadata, poll_results=poll_results,
+                                   ballots=ballots, votes_page=votes_page,
+                                   attendees=attendees, attendees_page=attendees_page).encode('utf-8')
+    return results_response(body, results_cache.put(cache_key, body))
+
+
+def results_cache_key(poll_id, votes_page, attendees_page):
+    return '{}:{}:{}:{}'.format(poll_id, get_locale(), votes_page, attendees_page)
+
+
+def results_response(body: bytes, etag: str):
+    # Results of a closed poll are final, so browsers may keep them forever and revalidate with the ETag
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Language')
+    return response.make_conditional(request)
 
 
 @app.route('/<poll_id>/submit_vote', methods=["POST"])
 def submit_vote(poll_id):
     token = request.form['token']
     answers = [int(x) for x in request.form.getlist('answer')]
+    if ballot_writer is not None:
+        try:
+            poll_label, state = ballot_writer.submit(poll_id, token, answers)
+        except BallotNotWritten:
+            return render_template('message.html', state="not_written"), 503
+        return render_template('message.html', poll_label=poll_label, state=state)
+    with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+        poll_label, state = session.submit_vote(poll_id, token, answers)
+        return render_template('message.html', poll_label=poll_label, state=state)
+
+
+@app.route('/admin/turnout/<poll_id>')
+def turnout_view(poll_id):
     with my_session_scope(my_database) as session:  # type: MyDatabaseSession
-        poll: Poll = session.get_poll_by_id(poll_id)
-        vote: Vote = session.get_vote(poll_id, token)
-        if not vote:
-            return render_template('message.html', poll_label=poll.label, state="token_invalid")
-        if poll.state != PollState.active:
-            return render_template('message.html', poll_label=poll.label, state="not_active")
-        # Validation of vote
-        if len(answers) > poll.numVotes:
-            return render_template('message.html', poll_label=poll.label, state="too_many_votes")
-        if len(answers) > 1 and session.contains_exclusive_answer(answers):
-            return render_template('message.html', poll_label=poll.label, state="invalid_combination")
-        vote.answerOptions.clear()
-        vote.association_ids.extend(answers)
-        return render_template('message.html', poll_label=poll.label, state="successful")
+        poll_metadata = session.get_poll_metadata(poll_id)
+        if poll_metadata is None:
+            abort(404)
+        return render_template('turnout.html', poll=poll_metadata)
 
 
 @app.route('/admin')
 @app.route('/admin/')
 def admin_overview():
+    state = request.args.get('state')
+    state = PollState[state] if state in PollState.__members__ else None
+    label = request.args.get('label', '').strip()
+    before = request.args.get('before', type=int)
     with my_session_scope(my_database) as session:  # type: MyDatabaseSession
-        prepared_polls = session.get_polls(PollState.prepared)
-        active_polls = session.get_polls(PollState.active)
-        closed_polls = session.get_polls(PollState.closed)
-        return render_template('admin_overview.html', prepared_polls=prepared_polls, active_polls=active_polls,
-                               closed_polls=closed_polls)
+        # One more poll than shown tells whether there is a next page
+        polls = session.get_poll_summaries(state, label, before, ADMIN_OVERVIEW_PAGE_SIZE + 1)
+    next_before = polls[ADMIN_OVERVIEW_PAGE_SIZE - 1].poll_id if len(polls) > ADMIN_OVERVIEW_PAGE_SIZE else None
+    return render_template('admin_overview.html', polls=polls[:ADMIN_OVERVIEW_PAGE_SIZE], state=state, label=label,
+                           next_before=next_before, poll_states=PollState)
 
 
 @app.route('/admin/new_poll', methods=['GET', 'POST'])
@@ -112,12 +201,137 @@ def activate_poll(poll_id):
                 return render_template('admin_message.html', msg="poll_activate_error", poll_id=poll_id)
 
 
+@app.route('/api/activate_poll/<poll_id>', methods=['POST'])
+def api_activate_poll(poll_id):
+    """Activates a poll with tokens and attendees sent as NDJSON body, which may use chunked transfer encoding.
+
+    Every line is either {"token": "..."} or {"attendee": "..."}. Rows are stored while the body is read.
+    """
+    if not BALLOT_BOX_API_TOKEN:
+        abort(404)
+    authorization = request.headers.get('Authorization', '').encode('utf-8')
+    if not hmac.compare_digest(authorization, ('Bearer ' + BALLOT_BOX_API_TOKEN).encode('utf-8')):
+        abort(401)
+    try:
+        with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+            counts = session.activate_poll_incrementally(poll_id, iter_ndjson_rows(request.stream))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if counts is None:
+        return jsonify(error="poll_not_prepared"), 409
+    num_tokens, num_attendees = counts
+    return jsonify(poll_id=poll_id, tokens=num_tokens, attendees=num_attendees)
+
+
+def iter_ndjson_rows(stream):
+    for line in iter(stream.readline, b''):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if not isinstance(row, dict) or len(row) != 1:
+            raise ValueError("Invalid row {}".format(line[:100]))
+        kind, value = next(iter(row.items()))
+        if kind not in (ROW_TOKEN, ROW_ATTENDEE) or not isinstance(value, str):
+            raise ValueError("Invalid row {}".format(line[:100]))
+        yield kind, value
+
+
 @app.route('/admin/close_poll/<poll_id>')
 def close_poll(poll_id):
     with my_session_scope(my_database) as session:  # type: MyDatabaseSession
         session.close_poll(poll_id)
         return render_template('admin_message.html', msg="poll_closed", poll_id=poll_id)
 
+
+@app.route('/admin/archive_poll/<poll_id>')
+def archive_poll(poll_id):
+    with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+        if session.archive_poll(poll_id):
+            return render_template('admin_message.html', msg="poll_archived", poll_id=poll_id)
+        return render_template('admin_message.html', msg="poll_archive_error", poll_id=poll_id)
+
+@app.route('/admin/export/<poll_id>/<kind>.<export_format>')
+def export_poll(poll_id, kind, export_format):
+    if kind not in EXPORT_KINDS or export_format not in EXPORT_FORMATS:
+        abort(404)
+    with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+        poll_metadata = session.get_poll_metadata(poll_id)
+        if poll_metadata is None or poll_metadata.state != PollState.closed:
+            abort(404)
+    columns = EXPORT_KINDS[kind]
+    mimetype, format_row = EXPORT_FORMATS[export_format]
+
+    def generate():
+        # The session has to stay open while the response is streamed
+        with my_session_scope(my_database) as export_session:  # type: MyDatabaseSession
+            if export_format == 'csv':
+                yield format_row(columns, columns)
+            if kind == 'ballots':
+                rows = export_session.iter_ballots(poll_id)
+            elif kind == 'tallies':
+                rows = ((option.answer_id, option.label, option.count)
+                        for option in export_session.get_results(poll_id))
+            else:
+                rows = ((name,) for name in export_session.iter_attendee_names(poll_id))
+            for row in rows:
+                yield format_row(columns, row)
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=poll-{}-{}.{}'.format(poll_id, kind,
+                                                                                          export_format)
+    return response
+
+
+def format_csv_row(_, row):
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerow(
+        ';'.join(str(x) for x in value) if isinstance(value, list) else value for value in row)
+    return output.getvalue()
+
+
+def format_ndjson_row(columns, row):
+    return json.dumps(dict(zip(columns, row)), ensure_ascii=False, sort_keys=True) + '\n'
+
+
+EXPORT_KINDS = {
+    'ballots': ('token', 'answer_ids', 'answer_labels'),
+    'tallies': ('answer_id', 'label', 'count'),
+    'attendees': ('name',),
+}
+EXPORT_FORMATS = {
+    'csv': ('text/csv', format_csv_row),
+    'ndjson': ('application/x-ndjson', format_ndjson_row),
+}
+
+
+@app.cli.command('check-tallies')
+@click.argument('poll_id')
+def check_tallies(poll_id):
+    """Recompute the results of a poll from its ballots and report differences to the stored tallies."""
+    with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+        drift = session.check_tallies(poll_id)
+    if not drift:
+        click.echo("Tallies of poll {} are consistent".format(poll_id))
+        return
+    for answer_id, (tally, actual) in sorted(drift.items(), key=lambda item: (item[0] is not None, item[0])):
+        option = "unsubmitted" if answer_id is None else "answer {}".format(answer_id)
+        click.echo("{}: tally {}, counted {}".format(option, tally, actual))
+    sys.exit(1)
+
+
+@app.cli.command('archive-polls')
+@click.argument('poll_ids', nargs=-1)
+def archive_polls(poll_ids):
+    """Archive the given closed polls, or all closed polls that are not archived yet, e.g. from a cron job."""
+    if not poll_ids:
+        with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+            poll_ids = session.get_archivable_poll_ids()
+    for poll_id in poll_ids:
+        # One transaction per poll keeps the locks short while ballots are submitted to active polls
+        with my_session_scope(my_database) as session:  # type: MyDatabaseSession
+            archived = session.archive_poll(poll_id)
+        click.echo("Poll {} {}".format(poll_id, "archived" if archived else "is not closed or already archived"))
+
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(app.config['LANGUAGES'])
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from db import MyDatabase, MyDatabaseSession, my_session_scope
+
+
+class PendingBallot:
+    def __init__(self, poll_id, token: str, answers: List[int]):
+        self.poll_id = poll_id
+        self.token = token
+        self.answers = answers
+        self.result: Optional[Tuple[Optional[str], str]] = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+        # Set if the request stopped waiting, the writer skips the ballot if it has not been written yet
+        self.abandoned = False
+
+
+class BallotNotWritten(Exception):
+    """The writer did not store a ballot within the timeout, the voter has to submit it again."""
+
+
+class BallotWriter:
+    """Group commit of submitted ballots.
+
+    Request threads enqueue their ballot and wait. A single writer thread validates and stores all ballots that
+    arrived within max_delay seconds (at most max_batch_size) in one transaction and wakes the request threads
+    after the commit, so a response is only sent once the ballot is durable. Requests wait at most timeout seconds,
+    a writer thread that died is replaced by the next submission.
+    """
+
+    def __init__(self, database: MyDatabase, max_batch_size: int = 100, max_delay: float = 0.02,
+                 timeout: float = 30):
+        self.database = database
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, poll_id, token: str, answers: List[int]) -> Tuple[Optional[str], str]:
+        self._ensure_started()
+        ballot = PendingBallot(poll_id, token, answers)
+        self._queue.put(ballot)
+        if not ballot.done.wait(self.timeout):
+            ballot.abandoned = True
+            raise BallotNotWritten()
+        if ballot.error is not None:
+            raise ballot.error
+        return ballot.result
+
+    def _ensure_started(self):
+        # Started lazily, so every gunicorn worker gets its own writer after forking
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ballot-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            batch = [ballot for ballot in batch if not ballot.abandoned]
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Keeps the writer alive, _write only fails here if waking the requests failed
+                for ballot in batch:
+                    if not ballot.done.is_set():
+                        ballot.error = e
+                        ballot.done.set()
+
+    def _write(self, batch: List[PendingBallot]):
+        try:
+            with my_session_scope(self.database) as session:  # type: MyDatabaseSession
+                results = [session.submit_vote(ballot.poll_id, ballot.token, ballot.answers) for ballot in batch]
+        except Exception as e:
+            if len(batch) > 1:
+                # Retry one by one, so a single failing ballot does not fail the others
+                for ballot in batch:
+                    self._write([ballot])
+                return
+            batch[0].error = e
+            batch[0].done.set()
+            return
+        for ballot, result in zip(batch, results):
+            ballot.result = result
+            ballot.done.set()
@@ -1,18 +1,37 @@
 import enum
+import fcntl
+import json
+import zlib
+from collections import namedtuple
 from contextlib import contextmanager
 from sqlite3 import Connection as SQLite3Connection
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import sqlalchemy.engine
 from sqlalchemy import Column, Integer, String, ForeignKey, event, create_engine, func, Enum, Table, \
-    ForeignKeyConstraint, Boolean
+    ForeignKeyConstraint, Boolean, LargeBinary, and_, case, distinct, exists, inspect, select
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session, Query
 from sqlalchemy.sql.expression import literal_column
 
+from poll_cache import AnswerOptionMetadata, PollMetadata, PollMetadataCache
+
 Base = declarative_base()
 
+# Number of rows per INSERT statement when activating a poll
+ACTIVATE_CHUNK_SIZE = 1000
+
+# Kinds of rows accepted by activate_poll_incrementally
+ROW_TOKEN = "token"
+ROW_ATTENDEE = "attendee"
+
+# Time SQLite waits for a lock held by another connection before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = 10000
+
+# Seconds a process waits on MySQL for another one to finish the schema upgrade
+SCHEMA_LOCK_TIMEOUT = 300
+
 
 class PollState(enum.Enum):
     prepared = 0
@@ -28,7 +47,7 @@ class PollType(enum.Enum):
 class Poll(Base):
     __tablename__ = "poll"
     poll_id = Column(Integer, primary_key=True)
-    state = Column(Enum(PollState), nullable=False, default=PollState.prepared)
+    state = Column(Enum(PollState), nullable=False, default=PollState.prepared, index=True)
     label = Column(String(1024), nullable=False)
     type = Column(Enum(PollType), nullable=False, default=PollType.singleVote)
     numVotes = Column(Integer, nullable=False, default=1)
@@ -41,7 +60,8 @@ class Poll(Base):
 association_table = Table('voteAnswers', Base.metadata,
                           Column('poll_id', Integer, primary_key=True),
                           Column('token', String(20), primary_key=True),
-                          Column('answer_id', Integer, ForeignKey('answer_option.answer_id'), primary_key=True),
+                          Column('answer_id', Integer, ForeignKey('answer_option.answer_id'), primary_key=True,
+                                 index=True),
                           ForeignKeyConstraint(('poll_id', 'token'), ('vote.poll_id', 'vote.token'))
                           )
 
@@ -54,7 +74,7 @@ class VoteAnswers(Base):
 class AnswerOption(Base):
     __tablename__ = "answer_option"
     answer_id = Column(Integer, primary_key=True)
-    poll_id = Column(Integer, ForeignKey(Poll.poll_id), nullable=False)
+    poll_id = Column(Integer, ForeignKey(Poll.poll_id), nullable=False, index=True)
     label = Column(String(1024), nullable=False)
     exclusive = Column(Boolean, nullable=False, default=False)
 
@@ -81,18 +101,75 @@ class Vote(Base):
 class Attendee(Base):
     __tablename__ = "attendee"
     attendee_id = Column(Integer, primary_key=True, autoincrement=True)
-    poll_id = Column(Integer, ForeignKey(Poll.poll_id))
+    poll_id = Column(Integer, ForeignKey(Poll.poll_id), index=True)
     name = Column(String(255))
 
     def __init__(self, name):
         self.name = name
 
 
+class AnswerTally(Base):
+    __tablename__ = "answer_tally"
+    answer_id = Column(Integer, ForeignKey(AnswerOption.answer_id), primary_key=True)
+    poll_id = Column(Integer, ForeignKey(Poll.poll_id), nullable=False, index=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class PollTally(Base):
+    __tablename__ = "poll_tally"
+    poll_id = Column(Integer, ForeignKey(Poll.poll_id), primary_key=True)
+    unsubmitted = Column(Integer, nullable=False, default=0)
+    # Number of issued tokens and attendees, so the admin overview does not have to count them
+    tokens = Column(Integer, nullable=False, default=0, server_default="0")
+    attendees = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class PollArchive(Base):
+    """Ballots and attendees of an archived poll, the rows in vote, voteAnswers and attendee are deleted.
+
+    Both are stored as zlib-compressed JSON lists: [token, [answer ids]] ordered by token and attendee names in the
+    order of registration. The results are still read from the tallies, which are recounted when archiving.
+    """
+    __tablename__ = "poll_archive"
+    poll_id = Column(Integer, ForeignKey(Poll.poll_id), primary_key=True)
+    ballots = Column(LargeBinary, nullable=False)
+    attendees = Column(LargeBinary, nullable=False)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+
+
+ResultRow = namedtuple("ResultRow", ["answer_id", "label", "count"])
+# Counts are None for polls that have not been activated
+PollSummary = namedtuple("PollSummary", ["poll_id", "label", "state", "type", "tokens", "submitted", "attendees",
+                                         "archived"])
+PollTurnout = namedtuple("PollTurnout", ["state", "tokens", "submitted"])
+# Decompressed contents of a PollArchive, ballots are (token, answer ids) tuples
+ArchivedPoll = namedtuple("ArchivedPoll", ["ballots", "attendees"])
+
+
+class BallotRow:
+    """Token of a ballot with its answers as bitset, bit i is set if the i-th answer of the given order was chosen."""
+
+    def __init__(self, token: str, answers: int):
+        self.token = token
+        self.answers = answers
+
+    def has_answer(self, index: int) -> bool:
+        return bool(self.answers >> index & 1)
+
+
 class MyDatabaseSession:
     session = None
+    poll_cache = None
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, poll_cache: PollMetadataCache):
         self.session = session
+        self.poll_cache = poll_cache
+        # Archives read in this session by poll_id, so a result page decompresses them only once
+        self.archives: Dict[str, Optional[ArchivedPoll]] = {}
 
     def commit(self):
         self.session.commit()
@@ -106,8 +183,38 @@ class MyDatabaseSession:
     def get_poll_by_id(self, poll_id: int) -> Poll:
         return self.session.query(Poll).filter(Poll.poll_id == poll_id).first()
 
-    def get_polls(self, state: PollState) -> List[Poll]:
-        return self.session.query(Poll).filter(Poll.state == state).all()
+    def get_poll_summaries(self, state: Optional[PollState] = None, label: Optional[str] = None,
+                           before: Optional[int] = None, limit: int = 50) -> List[PollSummary]:
+        """Returns the newest polls with poll_id < before, optionally filtered, with their counts in one query.
+
+        Ballots without answers count as unsubmitted, like on the result page.
+        """
+        query = self.session.query(Poll.poll_id, Poll.label, Poll.state, Poll.type,
+                                   PollTally.tokens, PollTally.unsubmitted, PollTally.attendees,
+                                   PollArchive.poll_id.isnot(None))\
+            .outerjoin(PollTally, PollTally.poll_id == Poll.poll_id)\
+            .outerjoin(PollArchive, PollArchive.poll_id == Poll.poll_id)
+        if state is not None:
+            query = query.filter(Poll.state == state)
+        if label:
+            query = query.filter(Poll.label.contains(label, autoescape=True))
+        if before is not None:
+            query = query.filter(Poll.poll_id < before)
+        return [PollSummary(poll_id, poll_label, poll_state, poll_type, tokens,
+                            None if tokens is None else tokens - unsubmitted, attendees, archived)
+                for poll_id, poll_label, poll_state, poll_type, tokens, unsubmitted, attendees, archived
+                in query.order_by(Poll.poll_id.desc()).limit(limit)]
+
+    def get_turnouts(self, poll_ids: List[int]) -> Dict[int, PollTurnout]:
+        """Reads the number of issued tokens and submitted ballots of several polls from the tallies.
+
+        Both are None for polls that have not been activated.
+        """
+        return {poll_id: PollTurnout(state, tokens, None if tokens is None else tokens - unsubmitted)
+                for poll_id, state, tokens, unsubmitted in
+                self.session.query(Poll.poll_id, Poll.state, PollTally.tokens, PollTally.unsubmitted)
+                    .outerjoin(PollTally, PollTally.poll_id == Poll.poll_id)
+                    .filter(Poll.poll_id.in_(poll_ids))}
 
     def add_poll(self, label: str, poll_type: PollType, num_votes: int, answer_options: List[str]) -> Poll:
         poll = Poll()
@@ -121,28 +228,232 @@ class MyDatabaseSession:
         self.session.flush()
         return poll
 
-    def activate_poll(self, poll_id: int, tokens: List[str], attendees: List[str]) -> bool:
-        poll = self.get_poll_by_id(poll_id)
-        if poll is None or poll.state != PollState.prepared:
+    def activate_poll(self, poll_id: int, tokens: List[str], attendees: List[str],
+                      chunk_size: int = ACTIVATE_CHUNK_SIZE) -> bool:
+        if len(set(tokens)) != len(tokens):
             return False
+        return self.activate_poll_incrementally(poll_id, [(ROW_TOKEN, token) for token in tokens]
+                                                + [(ROW_ATTENDEE, name) for name in attendees], chunk_size) is not None
+
+    def activate_poll_incrementally(self, poll_id: int, rows: Iterable[Tuple[str, str]],
+                                    chunk_size: int = ACTIVATE_CHUNK_SIZE) -> Optional[Tuple[int, int]]:
+        """Activates a poll with tokens and attendees given as (ROW_TOKEN or ROW_ATTENDEE, value) in any order.
+
+        Rows are inserted in chunks while they are read, so rows can be streamed from a request. Returns the number of
+        tokens and attendees or None if the poll is not prepared. Raises ValueError for duplicate tokens or unknown row
+        kinds, the caller has to roll back the session then.
+        """
+        poll = self.session.query(Poll).filter(Poll.poll_id == poll_id).with_for_update().first()
+        if poll is None or poll.state != PollState.prepared:
+            return None
         poll.state = PollState.active
-        for token in tokens:
-            poll.votes.append(Vote(token))
-        for attendee in attendees:
-            poll.attendees.append(Attendee(attendee))
-        return True
+        seen_tokens = set()
+        num_attendees = 0
+        token_chunk = []
+        attendee_chunk = []
+        # Insert via Core executemany in chunks instead of creating one ORM object per row
+        for kind, value in rows:
+            if kind == ROW_TOKEN:
+                if value in seen_tokens:
+                    raise ValueError("Duplicate token")
+                seen_tokens.add(value)
+                token_chunk.append({"poll_id": poll.poll_id, "token": value})
+                if len(token_chunk) >= chunk_size:
+                    self.session.execute(Vote.__table__.insert(), token_chunk)
+                    token_chunk = []
+            elif kind == ROW_ATTENDEE:
+                num_attendees += 1
+                attendee_chunk.append({"poll_id": poll.poll_id, "name": value})
+                if len(attendee_chunk) >= chunk_size:
+                    self.session.execute(Attendee.__table__.insert(), attendee_chunk)
+                    attendee_chunk = []
+            else:
+                raise ValueError("Unknown row kind {}".format(kind))
+        if token_chunk:
+            self.session.execute(Vote.__table__.insert(), token_chunk)
+        if attendee_chunk:
+            self.session.execute(Attendee.__table__.insert(), attendee_chunk)
+        num_tokens = len(seen_tokens)
+        # Tallies are kept up to date by submit_vote, so get_results does not need to scan all ballots
+        self.session.execute(PollTally.__table__.insert(), {"poll_id": poll.poll_id, "unsubmitted": num_tokens,
+                                                            "tokens": num_tokens, "attendees": num_attendees})
+        answer_ids = [answer_id for answer_id, in
+                      self.session.query(AnswerOption.answer_id).filter(AnswerOption.poll_id == poll.poll_id)]
+        if answer_ids:
+            self.session.execute(AnswerTally.__table__.insert(),
+                                 [{"answer_id": answer_id, "poll_id": poll.poll_id, "count": 0}
+                                  for answer_id in answer_ids])
+        return num_tokens, num_attendees
 
     def close_poll(self, poll_id: int):
         poll: Poll = self.get_poll_by_id(poll_id)
         poll.state = PollState.closed
 
-    def get_vote(self, poll_id, token) -> Vote:
-        return self.session.query(Vote).filter(Vote.poll_id == poll_id, Vote.token == token).first()
+    def get_archive(self, poll_id) -> Optional[ArchivedPoll]:
+        """Returns the ballots and attendees of an archived poll, None if the poll has not been archived."""
+        if poll_id not in self.archives:
+            row = self.session.query(PollArchive.ballots, PollArchive.attendees)\
+                .filter(PollArchive.poll_id == poll_id).first()
+            self.archives[poll_id] = None if row is None else ArchivedPoll(
+                [(token, answer_ids) for token, answer_ids in json.loads(zlib.decompress(row.ballots))],
+                json.loads(zlib.decompress(row.attendees)))
+        return self.archives[poll_id]
+
+    def get_archivable_poll_ids(self) -> List[int]:
+        """Returns the closed polls that have not been archived yet."""
+        return [poll_id for poll_id, in self.session.query(Poll.poll_id)
+                .outerjoin(PollArchive, PollArchive.poll_id == Poll.poll_id)
+                .filter(Poll.state == PollState.closed, PollArchive.poll_id.is_(None))
+                .order_by(Poll.poll_id)]
+
+    def archive_poll(self, poll_id: int) -> bool:
+        """Moves the ballots and attendees of a closed poll into a compressed PollArchive.
+
+        The tallies are recounted from the ballots first, as they are the only source of the results afterwards.
+        Returns False if the poll is not closed or already archived.
+        """
+        poll = self.session.query(Poll).filter(Poll.poll_id == poll_id).with_for_update().first()
+        if poll is None or poll.state != PollState.closed or self.get_archive(poll.poll_id) is not None:
+            return False
+        poll_id = poll.poll_id
+        ballots = [[token, answer_ids] for token, answer_ids, _ in self.iter_ballots(poll_id)]
+        attendees = list(self.iter_attendee_names(poll_id))
+        results = self.compute_results(poll_id)
+        self.session.execute(AnswerTally.__table__.delete().where(AnswerTally.poll_id == poll_id))
+        self.session.execute(PollTally.__table__.delete().where(PollTally.poll_id == poll_id))
+        self.session.execute(PollTally.__table__.insert(), {
+            "poll_id": poll_id, "tokens": len(ballots), "attendees": len(attendees),
+            "unsubmitted": sum(row.count for row in results if row.answer_id is None)})
+        answer_tallies = [{"answer_id": row.answer_id, "poll_id": poll_id, "count": row.count}
+                          for row in results if row.answer_id is not None]
+        if answer_tallies:
+            self.session.execute(AnswerTally.__table__.insert(), answer_tallies)
+        self.session.execute(PollArchive.__table__.insert(), {
+            "poll_id": poll_id,
+            "ballots": zlib.compress(json.dumps(ballots, separators=(",", ":")).encode("utf-8"), 9),
+            "attendees": zlib.compress(json.dumps(attendees, separators=(",", ":")).encode("utf-8"), 9)})
+        self.session.execute(association_table.delete().where(association_table.c.poll_id == poll_id))
+        self.session.execute(Vote.__table__.delete().where(Vote.poll_id == poll_id))
+        self.session.execute(Attendee.__table__.delete().where(Attendee.poll_id == poll_id))
+        self.archives.pop(poll_id, None)
+        return True
 
-    def get_votes(self, poll_id) -> List[Vote]:
-        return self.session.query(Vote).filter(Vote.poll_id == poll_id).all()
+    def count_votes(self, poll_id) -> int:
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            return len(archive.ballots)
+        return self.session.query(func.count(Vote.token)).filter(Vote.poll_id == poll_id).scalar()
+
+    def get_ballots(self, poll_id, answer_ids: List[Optional[int]], offset: int, limit: int) -> List[BallotRow]:
+        """Loads a page of ballots ordered by token together with their answers in one query."""
+        answer_bits = {answer_id: 1 << index for index, answer_id in enumerate(answer_ids) if answer_id is not None}
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            return [BallotRow(token, sum(answer_bits.get(answer_id, 0) for answer_id in ballot_answer_ids))
+                    for token, ballot_answer_ids in archive.ballots[offset:offset + limit]]
+        tokens = self.session.query(Vote.token)\
+            .filter(Vote.poll_id == poll_id)\
+            .order_by(Vote.token)\
+            .offset(offset).limit(limit)\
+            .subquery()
+        rows = self.session.query(tokens.c.token, VoteAnswers.answer_id)\
+            .outerjoin(VoteAnswers, and_(VoteAnswers.poll_id == poll_id, VoteAnswers.token == tokens.c.token))\
+            .order_by(tokens.c.token)
+        ballots: List[BallotRow] = []
+        for token, answer_id in rows:
+            if not ballots or ballots[-1].token != token:
+                ballots.append(BallotRow(token, 0))
+            ballots[-1].answers |= answer_bits.get(answer_id, 0)
+        return ballots
+
+    def iter_ballots(self, poll_id, batch_size: int = 1000) -> Iterator[Tuple[str, List[int], List[str]]]:
+        """Streams all ballots ordered by token as (token, answer ids, answer labels) using a server-side cursor."""
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            labels = dict(self.session.query(AnswerOption.answer_id, AnswerOption.label)
+                          .filter(AnswerOption.poll_id == poll_id))
+            for token, answer_ids in archive.ballots:
+                yield token, answer_ids, [labels[answer_id] for answer_id in answer_ids]
+            return
+        rows = self.session.query(Vote.token, AnswerOption.answer_id, AnswerOption.label)\
+            .select_from(Vote)\
+            .outerjoin(VoteAnswers, and_(VoteAnswers.poll_id == Vote.poll_id, VoteAnswers.token == Vote.token))\
+            .outerjoin(AnswerOption, AnswerOption.answer_id == VoteAnswers.answer_id)\
+            .filter(Vote.poll_id == poll_id)\
+            .order_by(Vote.token, AnswerOption.answer_id)\
+            .execution_options(stream_results=True)\
+            .yield_per(batch_size)
+        current_token = None
+        answer_ids: List[int] = []
+        answer_labels: List[str] = []
+        for token, answer_id, label in rows:
+            if token != current_token:
+                if current_token is not None:
+                    yield current_token, answer_ids, answer_labels
+                current_token, answer_ids, answer_labels = token, [], []
+            if answer_id is not None:
+                answer_ids.append(answer_id)
+                answer_labels.append(label)
+        if current_token is not None:
+            yield current_token, answer_ids, answer_labels
+
+    def iter_attendee_names(self, poll_id, batch_size: int = 1000) -> Iterator[str]:
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            yield from archive.attendees
+            return
+        rows = self.session.query(Attendee.name)\
+            .filter(Attendee.poll_id == poll_id)\
+            .order_by(Attendee.attendee_id)\
+            .execution_options(stream_results=True)\
+            .yield_per(batch_size)
+        for name, in rows:
+            yield name
+
+    def count_attendees(self, poll_id) -> int:
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            return len(archive.attendees)
+        return self.session.query(func.count(Attendee.attendee_id)).filter(Attendee.poll_id == poll_id).scalar()
+
+    def get_attendee_names(self, poll_id, offset: int, limit: int) -> List[str]:
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            return archive.attendees[offset:offset + limit]
+        return [name for name, in self.session.query(Attendee.name)
+                .filter(Attendee.poll_id == poll_id)
+                .order_by(Attendee.attendee_id)
+                .offset(offset).limit(limit)]
 
     def get_results(self, poll_id) -> List:
+        unsubmitted = self.session.query(PollTally.unsubmitted).filter(PollTally.poll_id == poll_id).scalar()
+        # Polls closed without being activated have no tallies, their options are listed with 0 votes
+        results = [ResultRow(answer_id, label, count) for answer_id, label, count in
+                   self.session.query(AnswerOption.answer_id, AnswerOption.label,
+                                      func.coalesce(AnswerTally.count, 0))
+                       .outerjoin(AnswerTally, AnswerTally.answer_id == AnswerOption.answer_id)
+                       .filter(AnswerOption.poll_id == poll_id)
+                       .order_by(AnswerOption.answer_id)]
+        if unsubmitted:
+            results.append(ResultRow(None, None, unsubmitted))
+        return results
+
+    def compute_results(self, poll_id) -> List:
+        """Counts the votes from the stored ballots instead of the tallies."""
+        archive = self.get_archive(poll_id)
+        if archive is not None:
+            labels = dict(self.session.query(AnswerOption.answer_id, AnswerOption.label)
+                          .filter(AnswerOption.poll_id == poll_id))
+            counts = dict.fromkeys(labels, 0)
+            unsubmitted = 0
+            for _, answer_ids in archive.ballots:
+                unsubmitted += not answer_ids
+                for answer_id in answer_ids:
+                    counts[answer_id] += 1
+            results = [ResultRow(answer_id, labels[answer_id], count) for answer_id, count in sorted(counts.items())]
+            if unsubmitted > 0:
+                results.append(ResultRow(None, None, unsubmitted))
+            return results
         # This union of queries simulates a full outer join
         q1: Query = self.session.query(AnswerOption.answer_id, AnswerOption.label, func.count(Vote.token).label("count"))\
             .select_from(Vote)\
@@ -154,28 +465,210 @@ class MyDatabaseSession:
             .filter(AnswerOption.poll_id == poll_id, VoteAnswers.token.is_(None))
         return q1.union(q2).all()
 
-    def contains_exclusive_answer(self, answer_options: List[int]) -> bool:
-        return self.session.query(AnswerOption)\
-                   .filter(AnswerOption.exclusive)\
-                   .filter(AnswerOption.answer_id.in_(answer_options))\
-                   .first() is not None
+    def get_poll_metadata(self, poll_id: int, state: Optional[PollState] = None) -> Optional[PollMetadata]:
+        """Returns the cached metadata of a poll, the state is read from the database if it is not given."""
+        if state is None:
+            row = self.session.query(Poll.poll_id, Poll.state).filter(Poll.poll_id == poll_id).first()
+            if row is None:
+                return None
+            poll_id, state = row
+        metadata = self.poll_cache.get(poll_id, state)
+        if metadata is None:
+            poll = self.get_poll_by_id(poll_id)
+            if poll is None:
+                return None
+            answer_options = tuple(AnswerOptionMetadata(option.answer_id, option.label, option.exclusive)
+                                   for option in poll.answer_options)
+            metadata = PollMetadata(poll.poll_id, poll.label, poll.type, poll.numVotes, poll.state, answer_options)
+            self.poll_cache.put(metadata)
+        return metadata
+
+    def submit_vote(self, poll_id: int, token: str, answers: List[int]) -> Tuple[Optional[str], str]:
+        """Validates and stores a ballot, returns the poll label and the resulting state for message.html."""
+        row = self.session.query(Poll.poll_id, Poll.state, Vote.token)\
+            .outerjoin(Vote, and_(Vote.poll_id == Poll.poll_id, Vote.token == token))\
+            .filter(Poll.poll_id == poll_id)\
+            .first()
+        if row is None:
+            return None, "token_invalid"
+        poll_id, state, vote_token = row
+        poll = self.get_poll_metadata(poll_id, state)
+        # Tokens of archived polls are no longer stored, but they are closed anyway
+        if vote_token is None and state != PollState.closed:
+            return poll.label, "token_invalid"
+        if state != PollState.active:
+            return poll.label, "not_active"
+        # Validation of vote
+        answer_ids = set(answers)
+        if len(answers) > poll.numVotes:
+            return poll.label, "too_many_votes"
+        if not answer_ids <= poll.valid_answer_ids \
+                or (len(answers) > 1 and not answer_ids.isdisjoint(poll.exclusive_answer_ids)):
+            return poll.label, "invalid_combination"
+        self._update_tallies(poll_id, token, answer_ids)
+        self.session.execute(association_table.delete().where(and_(association_table.c.poll_id == poll_id,
+                                                                   association_table.c.token == token)))
+        if answer_ids:
+            self.session.execute(association_table.insert().values(
+                [{"poll_id": poll_id, "token": token, "answer_id": answer_id} for answer_id in answer_ids]))
+        return poll.label, "successful"
+
+    def _update_tallies(self, poll_id: int, token: str, answer_ids: Set[int]):
+        """Moves a ballot's contribution from its stored answers to answer_ids, has to run before they are replaced."""
+        previous_answers = select([association_table.c.answer_id])\
+            .where(and_(association_table.c.poll_id == poll_id, association_table.c.token == token))
+        answer_tally = AnswerTally.__table__
+        new_count = answer_tally.c.count - case([(answer_tally.c.answer_id.in_(previous_answers), 1)], else_=0)
+        if answer_ids:
+            new_count = new_count + case([(answer_tally.c.answer_id.in_(answer_ids), 1)], else_=0)
+        self.session.execute(answer_tally.update()
+                             .where(answer_tally.c.poll_id == poll_id)
+                             .values(count=new_count))
+        poll_tally = PollTally.__table__
+        self.session.execute(poll_tally.update()
+                             .where(poll_tally.c.poll_id == poll_id)
+                             .values(unsubmitted=poll_tally.c.unsubmitted
+                                     + (0 if answer_ids else 1)
+                                     - case([(exists(previous_answers), 0)], else_=1)))
+
+    def check_tallies(self, poll_id: int) -> Dict[Optional[int], Tuple[int, int]]:
+        """Compares the tallies with the stored ballots and returns answer_id -> (tally, actual) for differences.
+
+        The number of unsubmitted ballots uses the key None.
+        """
+        unsubmitted = self.session.query(PollTally.unsubmitted).filter(PollTally.poll_id == poll_id).scalar()
+        tallies = {answer_id: count for answer_id, count in
+                   self.session.query(AnswerTally.answer_id, AnswerTally.count).filter(AnswerTally.poll_id == poll_id)}
+        tallies[None] = unsubmitted or 0
+        actual = {row.answer_id: row.count for row in self.compute_results(poll_id)}
+        drift = {}
+        for answer_id in set(tallies) | set(actual):
+            if tallies.get(answer_id, 0) != actual.get(answer_id, 0):
+                drift[answer_id] = (tallies.get(answer_id, 0), actual.get(answer_id, 0))
+        return drift
 
 
 class MyDatabase:
     db_engine = None
 
-    def __init__(self, database_url):
+    def __init__(self, database_url, poll_cache_size=128, sqlite_wal=False):
+        self.poll_cache = PollMetadataCache(poll_cache_size)
         self.db_engine = create_engine(database_url, pool_pre_ping=True, echo=False)
-        try:
+        if sqlite_wal:
+            event.listen(self.db_engine, "connect", _set_sqlite_wal)
+        # All gunicorn workers start at the same time, only one of them may create and upgrade the schema.
+        # Errors are not caught, a worker must not run against a schema it does not know.
+        with schema_lock(self.db_engine):
+            new_database = Poll.__tablename__ not in inspect(self.db_engine).get_table_names()
             Base.metadata.create_all(self.db_engine)
-            # print("Tables created")
-        except Exception as e:
-            print("Error occurred during Table creation!")
-            print(e)
+            upgrade_schema(self.db_engine, new_database)
         self.Session = sessionmaker(bind=self.db_engine)
 
     def get_session(self) -> MyDatabaseSession:
-        return MyDatabaseSession(self.Session())
+        return MyDatabaseSession(self.Session(), self.poll_cache)
+
+
+def _create_missing_indexes(connection):
+    """Adds the indexes declared on the models to tables created before they were introduced.
+
+    Indexes whose columns are already the leading columns of another index are skipped. MySQL (InnoDB) creates such an
+    index for every foreign key, a second one would only slow down inserts.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = inspector.get_indexes(table.name)
+        names = {index["name"] for index in existing}
+        covered = [tuple(index["column_names"]) for index in existing]
+        covered.append(tuple(inspector.get_pk_constraint(table.name)["constrained_columns"]))
+        for index in table.indexes:
+            columns = tuple(column.name for column in index.columns)
+            if index.name not in names and not any(other[:len(columns)] == columns for other in covered):
+                index.create(bind=connection)
+
+
+def _add_poll_tally_counts(connection):
+    """Adds the number of tokens and attendees to the tallies of polls activated before they were stored."""
+    columns = {column["name"] for column in inspect(connection).get_columns(PollTally.__tablename__)}
+    poll_tally = PollTally.__table__
+    for column in (poll_tally.c.tokens, poll_tally.c.attendees):
+        if column.name not in columns:
+            connection.execute("ALTER TABLE {} ADD COLUMN {} INTEGER NOT NULL DEFAULT 0"
+                               .format(poll_tally.name, column.name))
+    connection.execute(poll_tally.update().values(
+        tokens=select([func.count(Vote.token)]).where(Vote.poll_id == poll_tally.c.poll_id).as_scalar(),
+        attendees=select([func.count(Attendee.attendee_id)])
+            .where(Attendee.poll_id == poll_tally.c.poll_id).as_scalar()))
+
+
+def _backfill_tallies(connection):
+    """Counts the tallies of polls activated before they were introduced, so results are always read from them."""
+    poll_tally = PollTally.__table__
+    answer_tally = AnswerTally.__table__
+    poll_ids = [poll_id for poll_id, in connection.execute(
+        select([Poll.poll_id])
+        .where(Poll.state != PollState.prepared)
+        .where(~exists().where(poll_tally.c.poll_id == Poll.poll_id))
+        .order_by(Poll.poll_id))]
+    for poll_id in poll_ids:
+        tokens = connection.execute(select([func.count()]).where(Vote.poll_id == poll_id)).scalar()
+        submitted = connection.execute(select([func.count(distinct(association_table.c.token))])
+                                       .where(association_table.c.poll_id == poll_id)).scalar()
+        attendees = connection.execute(select([func.count()]).where(Attendee.poll_id == poll_id)).scalar()
+        connection.execute(poll_tally.insert(), {"poll_id": poll_id, "unsubmitted": tokens - submitted,
+                                                 "tokens": tokens, "attendees": attendees})
+        counts = dict(connection.execute(select([association_table.c.answer_id, func.count()])
+                                         .where(association_table.c.poll_id == poll_id)
+                                         .group_by(association_table.c.answer_id)).fetchall())
+        answer_ids = [answer_id for answer_id, in connection.execute(
+            select([AnswerOption.answer_id]).where(AnswerOption.poll_id == poll_id))]
+        if answer_ids:
+            connection.execute(answer_tally.insert(), [{"answer_id": answer_id, "poll_id": poll_id,
+                                                        "count": counts.get(answer_id, 0)}
+                                                       for answer_id in answer_ids])
+
+
+# Migration i brings the schema from version i to i + 1. Tables are added by create_all, so migrations only need to
+# change existing tables. New databases are created with the current schema and start at the latest version.
+MIGRATIONS = [
+    _create_missing_indexes,
+    _add_poll_tally_counts,
+    _backfill_tallies,
+]
+
+
+@contextmanager
+def schema_lock(engine):
+    """Serializes schema changes of several processes using the same database."""
+    if engine.dialect.name == "mysql":
+        lock_name = "secret-voting-schema:{}".format(engine.url.database)
+        with engine.connect() as connection:
+            if connection.execute(select([func.get_lock(lock_name, SCHEMA_LOCK_TIMEOUT)])).scalar() != 1:
+                raise RuntimeError("Timeout while waiting for the schema lock")
+            try:
+                yield
+            finally:
+                connection.execute(select([func.release_lock(lock_name)]))
+    elif engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+        # A lock file next to the database, as all processes using an SQLite file run on the same host
+        with open(engine.url.database + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def upgrade_schema(engine, new_database: bool):
+    with engine.begin() as connection:
+        version = connection.execute(select([func.max(SchemaVersion.version)])).scalar()
+        if version is None:
+            version = len(MIGRATIONS) if new_database else 0
+            connection.execute(SchemaVersion.__table__.insert(), {"version": version})
+        for target_version in range(version + 1, len(MIGRATIONS) + 1):
+            MIGRATIONS[target_version - 1](connection)
+            connection.execute(SchemaVersion.__table__.update().values(version=target_version))
 
 
 @contextmanager
@@ -197,4 +690,16 @@ def _set_sqlite_pragma(dbapi_connection, _connection_record):
     if isinstance(dbapi_connection, SQLite3Connection):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON;")
+        cursor.execute("PRAGMA busy_timeout={};".format(SQLITE_BUSY_TIMEOUT_MS))
+        cursor.close()
+
+
+def _set_sqlite_wal(dbapi_connection, _connection_record):
+    # Readers do not block the writer in WAL mode, used together with the group commit of ballots.
+    # FULL syncs the WAL on every commit, so an answered ballot survives a power loss. The group commit keeps the
+    # number of syncs low.
+    if isinstance(dbapi_connection, SQLite3Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=FULL;")
         cursor.close()
@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+
+from flask import Flask, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+
+REQUEST_LATENCY = Histogram('ballot_box_request_duration_seconds', 'Latency of HTTP requests', ['endpoint'])
+DB_QUERY_LATENCY = Histogram('ballot_box_db_query_duration_seconds', 'Latency of database statements')
+DB_QUERIES_PER_REQUEST = Histogram('ballot_box_db_queries_per_request', 'Database statements per HTTP request',
+                                   buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32, 64))
+
+_query_counter = threading.local()
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany):
+        context._metrics_start_time = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany):
+        DB_QUERY_LATENCY.observe(time.perf_counter() - context._metrics_start_time)
+        _query_counter.count = getattr(_query_counter, 'count', 0) + 1
+
+
+def instrument_app(app: Flask):
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start_time = time.perf_counter()
+        _query_counter.count = 0
+
+    @app.after_request
+    def _observe_request(response):
+        if 'metrics_start_time' in g:
+            REQUEST_LATENCY.labels(request.endpoint or 'unknown')\
+                .observe(time.perf_counter() - g.metrics_start_time)
+            DB_QUERIES_PER_REQUEST.observe(getattr(_query_counter, 'count', 0))
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            # Several gunicorn workers write their metrics into this directory
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import FrozenSet, Optional, Tuple
+
+
+class AnswerOptionMetadata:
+    def __init__(self, answer_id: int, label: str, exclusive: bool):
+        self.answer_id = answer_id
+        self.label = label
+        self.exclusive = exclusive
+
+
+class PollMetadata:
+    """Data of a poll that does not change after it has been created, plus the state it was loaded in.
+
+    Provides the attributes of Poll used by index.html, so it can be rendered without loading the ORM object.
+    """
+
+    def __init__(self, poll_id: int, label: str, poll_type, num_votes: int, state,
+                 answer_options: Tuple[AnswerOptionMetadata, ...]):
+        self.poll_id = poll_id
+        self.label = label
+        self.type = poll_type
+        self.numVotes = num_votes
+        self.state = state
+        self.answer_options = answer_options
+        self.valid_answer_ids: FrozenSet[int] = frozenset(option.answer_id for option in answer_options)
+        self.exclusive_answer_ids: FrozenSet[int] = frozenset(option.answer_id for option in answer_options
+                                                              if option.exclusive)
+
+
+class PollMetadataCache:
+    """Bounded LRU cache of PollMetadata.
+
+    A poll's state only moves forward (prepared, active, closed), so the state serves as the version of an entry.
+    Callers pass the state they read from the database and get None if the cached entry is older, which keeps the
+    cache correct across several worker processes.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, poll_id: int, state) -> Optional[PollMetadata]:
+        with self._lock:
+            metadata = self._entries.get(poll_id)
+            if metadata is None:
+                return None
+            if metadata.state != state:
+                del self._entries[poll_id]
+                return None
+            self._entries.move_to_end(poll_id)
+            return metadata
+
+    def put(self, metadata: PollMetadata):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[metadata.poll_id] = metadata
+            self._entries.move_to_end(metadata.poll_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Tuple
+
+
+class ResultsCache:
+    """Rendered result pages of closed polls, which never change once rendered.
+
+    Entries are the encoded page and its strong ETag, keyed by poll, locale and page numbers.
+    """
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        raise NotImplementedError
+
+    def put(self, key: str, body: bytes) -> str:
+        """Stores a rendered page and returns its ETag."""
+        raise NotImplementedError
+
+
+def _etag(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class InProcessResultsCache(ResultsCache):
+    """Bounded LRU cache in the memory of this process."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body):
+        etag = _etag(body)
+        if self.maxsize <= 0:
+            return etag
+        with self._lock:
+            self._entries[key] = (body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return etag
+
+
+class DirectoryResultsCache(ResultsCache):
+    """Keeps one file per page in a directory, so all worker processes share the rendered pages.
+
+    Files are written atomically. The directory is only listed once the files counted by this process may exceed
+    maxsize, then the oldest files are removed down to 90 percent of maxsize. Files written by other processes meanwhile
+    can let the directory exceed maxsize until one of them lists it.
+    """
+
+    def __init__(self, directory: str, maxsize: int):
+        self.directory = directory
+        self.maxsize = maxsize
+        # Files as of the last listing plus the ones this process wrote since, None before the first listing
+        self._files = None
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.html')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                etag = f.readline().rstrip(b'\n').decode('ascii')
+                return f.read(), etag
+        except OSError:
+            return None
+
+    def put(self, key, body):
+        etag = _etag(body)
+        if self.maxsize <= 0:
+            return etag
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(etag.encode('ascii') + b'\n')
+            f.write(body)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            if self._files is not None and self._files < self.maxsize:
+                self._files += 1
+            else:
+                self._files = self._evict()
+        return etag
+
+    def _evict(self) -> int:
+        """Removes the oldest files beyond 90 percent of maxsize and returns the number of files left."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.html'):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+            except OSError:
+                pass
+        keep = max(1, self.maxsize * 9 // 10)
+        if len(entries) <= keep:
+            return len(entries)
+        entries.sort()
+        for _, name in entries[:len(entries) - keep]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return keep
+
+
+def create_results_cache(directory: Optional[str], maxsize: int) -> ResultsCache:
+    if directory:
+        return DirectoryResultsCache(directory, maxsize)
+    return InProcessResultsCache(maxsize)
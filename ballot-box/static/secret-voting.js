@@ -1,3 +1,31 @@
 function admin_new_poll_add() {
     $('#answers').append('<input type="text" name="answer[]" class="form-control"><br>');
 }
+
+// Milliseconds before a stream that was refused (e.g. too many watchers) is opened again
+const TURNOUT_RETRY_INTERVAL = 10000;
+
+function watch_turnout(element) {
+    let source = new EventSource(element.data('turnout-url'));
+    source.onmessage = function (event) {
+        let turnout = JSON.parse(event.data);
+        element.find('.turnout-submitted').text(turnout.submitted === null ? '' : turnout.submitted);
+        element.find('.turnout-tokens').text(turnout.tokens === null ? '' : turnout.tokens);
+        // The numbers are final once the poll is closed
+        if (turnout.state === 'closed') {
+            source.close();
+        }
+    };
+    source.onerror = function () {
+        // Lost connections are reopened by the browser, refused streams are not
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(watch_turnout, TURNOUT_RETRY_INTERVAL, element);
+        }
+    };
+}
+
+$(document).ready(function () {
+    $('[data-turnout-url]').each(function () {
+        watch_turnout($(this));
+    });
+});
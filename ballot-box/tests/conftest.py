@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app.py opens the database at import
+os.environ['DB_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+
+import app as ballot_box  # noqa: E402
+from db import PollType, association_table, my_session_scope  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    return ballot_box.my_database
+
+
+@pytest.fixture
+def client():
+    return ballot_box.app.test_client()
+
+
+@pytest.fixture
+def make_poll(database):
+    """Creates a poll, activates it with the given tokens and attendees and returns its id and answer ids."""
+    def make_poll(tokens=(), attendees=(), answers=('Yes', 'No', 'Abstain'), poll_type=PollType.singleVote,
+                  num_votes=1):
+        with my_session_scope(database) as session:
+            poll = session.add_poll('Poll', poll_type, num_votes, list(answers))
+            poll_id = poll.poll_id
+            answer_ids = [option.answer_id for option in poll.answer_options]
+        if tokens or attendees:
+            with my_session_scope(database) as session:
+                session.activate_poll(poll_id, list(tokens), list(attendees))
+        return poll_id, answer_ids
+    return make_poll
+
+
+def insert_ballots(database, poll_id, ballots):
+    """Stores ballots given as (token, answer ids) with bulk inserts, the tallies are not updated."""
+    rows = [{'poll_id': poll_id, 'token': token, 'answer_id': answer_id}
+            for token, answer_ids in ballots for answer_id in answer_ids]
+    with my_session_scope(database) as session:
+        for i in range(0, len(rows), 10000):
+            session.session.execute(association_table.insert(), rows[i:i + 10000])
+
+
+# Schema of the first release, which databases of existing deployments still have
+BASELINE_SCHEMA = """
+CREATE TABLE poll (
+    poll_id INTEGER NOT NULL,
+    state VARCHAR(8) NOT NULL,
+    label VARCHAR(1024) NOT NULL,
+    type VARCHAR(15) NOT NULL,
+    "numVotes" INTEGER NOT NULL,
+    PRIMARY KEY (poll_id),
+    CONSTRAINT pollstate CHECK (state IN ('prepared', 'active', 'closed')),
+    CONSTRAINT polltype CHECK (type IN ('singleVote', 'multiPersonVote'))
+);
+CREATE TABLE answer_option (
+    answer_id INTEGER NOT NULL,
+    poll_id INTEGER NOT NULL,
+    label VARCHAR(1024) NOT NULL,
+    "exclusive" BOOLEAN NOT NULL,
+    PRIMARY KEY (answer_id),
+    FOREIGN KEY(poll_id) REFERENCES poll (poll_id),
+    CHECK ("exclusive" IN (0, 1))
+);
+CREATE TABLE vote (
+    poll_id INTEGER NOT NULL,
+    token VARCHAR(20) NOT NULL,
+    PRIMARY KEY (poll_id, token),
+    FOREIGN KEY(poll_id) REFERENCES poll (poll_id)
+);
+CREATE TABLE attendee (
+    attendee_id INTEGER NOT NULL,
+    poll_id INTEGER,
+    name VARCHAR(255),
+    PRIMARY KEY (attendee_id),
+    FOREIGN KEY(poll_id) REFERENCES poll (poll_id)
+);
+CREATE TABLE "voteAnswers" (
+    poll_id INTEGER NOT NULL,
+    token VARCHAR(20) NOT NULL,
+    answer_id INTEGER NOT NULL,
+    PRIMARY KEY (poll_id, token, answer_id),
+    FOREIGN KEY(poll_id, token) REFERENCES vote (poll_id, token),
+    FOREIGN KEY(answer_id) REFERENCES answer_option (answer_id)
+);
+"""
+
+
+@pytest.fixture
+def baseline_database(tmp_path):
+    """Path of an SQLite file with the baseline schema, the SQL statements given to it are run after the schema."""
+    def baseline_database(statements=''):
+        path = str(tmp_path / 'baseline.sqlite')
+        connection = sqlite3.connect(path)
+        connection.executescript(BASELINE_SCHEMA + statements)
+        connection.close()
+        return path
+    return baseline_database
@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+import app as ballot_box
+from db import Attendee, Poll, PollState, Vote, my_session_scope
+
+API_TOKEN = 'secret'
+
+
+@pytest.fixture
+def api(client, monkeypatch):
+    monkeypatch.setattr(ballot_box, 'BALLOT_BOX_API_TOKEN', API_TOKEN)
+
+    def activate(poll_id, body, token=API_TOKEN, headers=(), **kwargs):
+        headers = dict(headers, Authorization='Bearer ' + token) if token is not None else dict(headers)
+        return client.post('/api/activate_poll/{}'.format(poll_id), data=body, headers=headers,
+                           content_type='application/x-ndjson', **kwargs)
+    return activate
+
+
+def ndjson(tokens=(), attendees=()):
+    return ''.join(json.dumps(row) + '\n' for row in [{'token': token} for token in tokens]
+                   + [{'attendee': name} for name in attendees]).encode('utf-8')
+
+
+def stored(database, poll_id):
+    """State, tokens and attendee names of a poll as stored in the database."""
+    with my_session_scope(database) as session:
+        state = session.session.query(Poll.state).filter(Poll.poll_id == poll_id).scalar()
+        tokens = sorted(token for token, in session.session.query(Vote.token).filter(Vote.poll_id == poll_id))
+        names = sorted(name for name, in session.session.query(Attendee.name).filter(Attendee.poll_id == poll_id))
+    return state, tokens, names
+
+
+def test_missing_or_wrong_token_is_rejected(api, database, make_poll):
+    poll_id, _ = make_poll()
+    assert api(poll_id, ndjson(['a']), token=None).status_code == 401
+    assert api(poll_id, ndjson(['a']), token='wrong').status_code == 401
+    assert api(poll_id, ndjson(['a']), token=API_TOKEN + 'x').status_code == 401
+    assert stored(database, poll_id) == (PollState.prepared, [], [])
+
+
+def test_api_is_disabled_without_token(api, make_poll, monkeypatch):
+    monkeypatch.setattr(ballot_box, 'BALLOT_BOX_API_TOKEN', None)
+    assert api(make_poll()[0], ndjson(['a'])).status_code == 404
+
+
+def test_poll_is_activated(api, database, make_poll):
+    poll_id, _ = make_poll()
+    response = api(poll_id, ndjson(['a', 'b'], ['Ann', 'Zoë']))
+    assert response.status_code == 200
+    assert response.get_json() == {'poll_id': str(poll_id), 'tokens': 2, 'attendees': 2}
+    assert stored(database, poll_id) == (PollState.active, ['a', 'b'], ['Ann', 'Zoë'])
+
+
+@pytest.mark.parametrize('body', [
+    ndjson(['a', 'b', 'a']),
+    ndjson(['a']) + b'not json\n',
+    ndjson(['a']) + b'{"token": "b", "attendee": "Ann"}\n',
+    ndjson(['a']) + b'{"voter": "b"}\n',
+    ndjson(['a']) + b'{"token": 1}\n',
+    ndjson(['a']) + b'["b"]\n',
+])
+def test_malformed_or_duplicate_rows_roll_back(api, database, make_poll, body):
+    poll_id, _ = make_poll()
+    # More rows than one insert chunk, so some were written before the bad row was read
+    response = api(poll_id, ndjson(['t{}'.format(i) for i in range(2500)], ['Ann']) + body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert stored(database, poll_id) == (PollState.prepared, [], [])
+    # The poll can still be activated
+    assert api(poll_id, ndjson(['a'])).status_code == 200
+
+
+def test_poll_that_is_not_prepared_is_not_activated(api, database, make_poll):
+    active, _ = make_poll(['a'])
+    response = api(active, ndjson(['b']))
+    assert response.status_code == 409 and response.get_json() == {'error': 'poll_not_prepared'}
+    assert stored(database, active) == (PollState.active, ['a'], [])
+    assert api(999999, ndjson(['b'])).status_code == 409
+
+
+def test_chunked_body_is_read_to_the_end(api, database, make_poll):
+    poll_id, _ = make_poll()
+    tokens = ['t{}'.format(i) for i in range(2500)]
+    body = io.BytesIO(ndjson(tokens, ['Ann']))
+    # Without Content-Length, as sent with Transfer-Encoding: chunked and decoded by the server
+    response = api(poll_id, None, input_stream=body, headers={'Transfer-Encoding': 'chunked'},
+                   environ_overrides={'wsgi.input_terminated': True})
+    assert response.get_json() == {'poll_id': str(poll_id), 'tokens': 2500, 'attendees': 1}
+    assert stored(database, poll_id) == (PollState.active, sorted(tokens), ['Ann'])
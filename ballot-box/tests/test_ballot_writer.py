@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+from ballot_writer import BallotNotWritten, BallotWriter
+from db import MyDatabase
+
+
+def test_ballots_are_written(database, make_poll):
+    poll_id, answer_ids = make_poll(['a', 'b'])
+    writer = BallotWriter(database, timeout=5)
+    assert writer.submit(poll_id, 'a', [answer_ids[0]]) == ('Poll', 'successful')
+    assert writer.submit(poll_id, 'x', [answer_ids[0]]) == ('Poll', 'token_invalid')
+
+
+def test_submit_times_out_if_the_writer_is_stuck(database, make_poll, monkeypatch):
+    poll_id, answer_ids = make_poll(['a', 'b'])
+    writer = BallotWriter(database, timeout=0.2)
+    release = threading.Event()
+    write = writer._write
+    monkeypatch.setattr(writer, '_write', lambda batch: release.wait() and write(batch))
+    with pytest.raises(BallotNotWritten):
+        writer.submit(poll_id, 'a', [answer_ids[0]])
+    release.set()
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_writer_is_restarted(database, make_poll, monkeypatch):
+    poll_id, answer_ids = make_poll(['a', 'b'])
+    writer = BallotWriter(database, timeout=0.5)
+    write = writer._write
+
+    def die(_):
+        raise SystemExit()
+
+    monkeypatch.setattr(writer, '_write', die)
+    with pytest.raises(BallotNotWritten):
+        writer.submit(poll_id, 'a', [answer_ids[0]])
+    writer._thread.join(1)
+    assert not writer._thread.is_alive()
+    monkeypatch.setattr(writer, '_write', write)
+    assert writer.submit(poll_id, 'a', [answer_ids[0]]) == ('Poll', 'successful')
+
+
+def test_group_commit_database_syncs_every_commit(tmp_path):
+    database = MyDatabase('sqlite:///' + str(tmp_path / 'wal.sqlite'), sqlite_wal=True)
+    with database.db_engine.connect() as connection:
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        # 2 is FULL, NORMAL would lose the last commits on a power loss
+        assert connection.execute('PRAGMA synchronous').scalar() == 2
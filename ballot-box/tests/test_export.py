@@ -0,0 +1,91 @@
+import hashlib
+import json
+import tracemalloc
+
+from conftest import insert_ballots
+from db import PollType, my_session_scope
+
+
+def export(client, poll_id, kind, export_format):
+    response = client.get('/admin/export/{}/{}.{}'.format(poll_id, kind, export_format))
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def close(database, poll_id):
+    with my_session_scope(database) as session:
+        session.close_poll(poll_id)
+
+
+def test_export_of_small_poll(client, database, make_poll):
+    poll_id, (yes, no, empty) = make_poll(['b', 'a', 'c'], ['Ann', 'Bob'], ['Yes', 'No', 'Empty'],
+                                          PollType.multiPersonVote, 2)
+    for token, answers in [('a', [yes, no]), ('b', [empty])]:
+        with my_session_scope(database) as session:
+            session.submit_vote(poll_id, token, answers)
+    close(database, poll_id)
+    assert export(client, poll_id, 'ballots', 'csv') == \
+        'token,answer_ids,answer_labels\na,{};{},Yes;No\nb,{},Empty\nc,,\n'.format(yes, no, empty)
+    assert [json.loads(line) for line in export(client, poll_id, 'ballots', 'ndjson').splitlines()] == [
+        {'token': 'a', 'answer_ids': [yes, no], 'answer_labels': ['Yes', 'No']},
+        {'token': 'b', 'answer_ids': [empty], 'answer_labels': ['Empty']},
+        {'token': 'c', 'answer_ids': [], 'answer_labels': []}]
+    assert export(client, poll_id, 'tallies', 'csv') == \
+        'answer_id,label,count\n{},Yes,1\n{},No,1\n{},Empty,1\n,,1\n'.format(yes, no, empty)
+    assert export(client, poll_id, 'attendees', 'csv') == 'name\nAnn\nBob\n'
+    assert export(client, poll_id, 'attendees', 'ndjson') == '{"name": "Ann"}\n{"name": "Bob"}\n'
+
+
+def test_poll_closed_without_activation_lists_its_options(client, database, make_poll):
+    poll_id, (yes, no, abstain) = make_poll()
+    close(database, poll_id)
+    with my_session_scope(database) as session:
+        assert session.get_results(poll_id) == [(yes, 'Yes', 0), (no, 'No', 0), (abstain, 'Abstain', 0)]
+    assert export(client, poll_id, 'tallies', 'csv') == \
+        'answer_id,label,count\n{},Yes,0\n{},No,0\n{},Abstain,0\n'.format(yes, no, abstain)
+
+
+def test_export_of_open_poll_is_not_found(client, make_poll):
+    poll_id, _ = make_poll(['a'])
+    assert client.get('/admin/export/{}/ballots.csv'.format(poll_id)).status_code == 404
+    assert client.get('/admin/export/{}/votes.csv'.format(poll_id)).status_code == 404
+
+
+def streamed_export(client, poll_id, kind, export_format):
+    """Returns the SHA-256 of an export, the number of lines and the peak of allocated memory while streaming it."""
+    tracemalloc.start()
+    try:
+        response = client.get('/admin/export/{}/{}.{}'.format(poll_id, kind, export_format), buffered=False)
+        digest = hashlib.sha256()
+        lines = 0
+        for chunk in response.response:
+            digest.update(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            lines += chunk.count('\n' if isinstance(chunk, str) else b'\n')
+        response.close()
+        return digest.hexdigest(), lines, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_export_of_100k_ballots_is_deterministic_with_bounded_memory(client, database, make_poll):
+    count = 100000
+    tokens = ['token{:06d}'.format(i) for i in range(count)]
+    attendees = ['Attendee {}'.format(i) for i in range(count)]
+    # Tokens are inserted in random order, the export is ordered by token
+    poll_id, answer_ids = make_poll(sorted(tokens, key=lambda token: hashlib.md5(token.encode()).digest()),
+                                    attendees)
+    insert_ballots(database, poll_id, [(token, [answer_ids[i % len(answer_ids)]])
+                                       for i, token in enumerate(tokens) if i % 10])
+    close(database, poll_id)
+    small_poll_id, small_answer_ids = make_poll(tokens[:1000], attendees[:1000])
+    insert_ballots(database, small_poll_id, [(token, [small_answer_ids[0]]) for token in tokens[:1000]])
+    close(database, small_poll_id)
+
+    for kind, export_format in [('ballots', 'csv'), ('ballots', 'ndjson'), ('attendees', 'csv')]:
+        first_digest, lines, peak = streamed_export(client, poll_id, kind, export_format)
+        second_digest, _, _ = streamed_export(client, poll_id, kind, export_format)
+        _, _, small_peak = streamed_export(client, small_poll_id, kind, export_format)
+        assert first_digest == second_digest
+        assert lines == count + (export_format == 'csv')
+        # Memory does not grow with the number of rows: 100 times the rows need less than 4 MiB more memory
+        assert peak < small_peak + 4 * 1024 * 1024, (kind, export_format, peak, small_peak)
@@ -0,0 +1,42 @@
+import os
+
+import app as ballot_box
+from db import my_session_scope
+from results_cache import DirectoryResultsCache, InProcessResultsCache
+
+
+def test_page_numbers_out_of_range_share_the_cache_entry_of_the_clamped_page(client, database, make_poll,
+                                                                             monkeypatch):
+    cache = InProcessResultsCache(100)
+    monkeypatch.setattr(ballot_box, 'results_cache', cache)
+    monkeypatch.setattr(ballot_box, 'RESULTS_PAGE_SIZE', 2)
+    poll_id, _ = make_poll(['a', 'b', 'c'], ['Ann', 'Bob', 'Cid'])
+    with my_session_scope(database) as session:
+        session.close_poll(poll_id)
+    last_page = client.get('/{}?votes_page=2&attendees_page=2'.format(poll_id)).get_data()
+    for query in ('votes_page=3&attendees_page=99', 'votes_page=2&attendees_page=1000000',
+                  'votes_page=02&attendees_page=2'):
+        assert client.get('/{}?{}'.format(poll_id, query)).get_data() == last_page
+    first_page = client.get('/{}'.format(poll_id)).get_data()
+    for query in ('votes_page=0', 'votes_page=-5&attendees_page=x', 'attendees_page=1.5'):
+        assert client.get('/{}?{}'.format(poll_id, query)).get_data() == first_page
+    assert len(cache._entries) == 2
+
+
+def test_directory_cache_lists_the_directory_rarely(tmp_path, monkeypatch):
+    cache = DirectoryResultsCache(str(tmp_path), 100)
+    listings = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, 'listdir', counting_listdir)
+    for i in range(1000):
+        cache.put('page{}'.format(i), b'page')
+        assert len(listdir(str(tmp_path))) <= 100
+    # Once at the first put and then every time the 10 percent headroom is used up
+    assert len(listings) <= 1 + 1000 // 10
+    assert cache.get('page999') == (b'page', cache.put('page999', b'page'))
+    assert cache.get('page0') is None
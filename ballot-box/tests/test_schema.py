@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+
+from sqlalchemy import inspect
+
+from db import MIGRATIONS, MyDatabase, ResultRow, my_session_scope
+
+
+def index_columns(database, table):
+    return {index['name']: index['column_names'] for index in inspect(database.db_engine).get_indexes(table)}
+
+
+def schema_versions(path):
+    connection = sqlite3.connect(path)
+    try:
+        return [version for version, in connection.execute('SELECT version FROM schema_version')]
+    finally:
+        connection.close()
+
+
+def test_baseline_database_is_upgraded(baseline_database):
+    path = baseline_database()
+    database = MyDatabase('sqlite:///' + path)
+    assert index_columns(database, 'poll')['ix_poll_state'] == ['state']
+    assert index_columns(database, 'answer_option')['ix_answer_option_poll_id'] == ['poll_id']
+    assert index_columns(database, 'attendee')['ix_attendee_poll_id'] == ['poll_id']
+    assert index_columns(database, 'voteAnswers')['ix_voteAnswers_answer_id'] == ['answer_id']
+    assert schema_versions(path) == [len(MIGRATIONS)]
+    # Opening the upgraded database again changes nothing
+    MyDatabase('sqlite:///' + path)
+    assert schema_versions(path) == [len(MIGRATIONS)]
+
+
+def test_tallies_of_polls_activated_before_them_are_backfilled(baseline_database):
+    path = baseline_database("""
+        INSERT INTO poll VALUES (1, 'closed', 'Closed', 'multiPersonVote', 2), (2, 'active', 'Active', 'singleVote', 1),
+            (3, 'prepared', 'Prepared', 'singleVote', 1);
+        INSERT INTO answer_option VALUES (1, 1, 'Ann', 0), (2, 1, 'Bob', 0), (3, 1, 'Nobody', 1), (4, 2, 'Yes', 0),
+            (5, 2, 'No', 0), (6, 3, 'Yes', 0);
+        INSERT INTO vote VALUES (1, 'a'), (1, 'b'), (1, 'c'), (1, 'd'), (2, 'e'), (2, 'f');
+        INSERT INTO "voteAnswers" VALUES (1, 'a', 1), (1, 'a', 2), (1, 'b', 1), (1, 'c', 3), (2, 'e', 4);
+        INSERT INTO attendee VALUES (1, 1, 'Ann'), (2, 1, 'Bob'), (3, 2, 'Cid');
+    """)
+    database = MyDatabase('sqlite:///' + path)
+    with my_session_scope(database) as session:
+        assert session.get_results(1) == [ResultRow(1, 'Ann', 2), ResultRow(2, 'Bob', 1), ResultRow(3, 'Nobody', 1),
+                                          ResultRow(None, None, 1)]
+        assert session.get_results(2) == [ResultRow(4, 'Yes', 1), ResultRow(5, 'No', 0), ResultRow(None, None, 1)]
+        assert session.check_tallies(1) == {} and session.check_tallies(2) == {}
+        assert [(row.poll_id, row.tokens, row.attendees) for row in session.get_poll_summaries()] == \
+            [(3, None, None), (2, 2, 1), (1, 4, 2)]
+        # Submissions keep counting from the backfilled tallies
+        session.submit_vote(2, 'f', [5])
+        assert session.get_results(2) == [ResultRow(4, 'Yes', 1), ResultRow(5, 'No', 1)]
+
+
+def test_new_database_starts_at_latest_version(tmp_path):
+    path = str(tmp_path / 'new.sqlite')
+    MyDatabase('sqlite:///' + path)
+    assert schema_versions(path) == [len(MIGRATIONS)]
+
+
+def test_index_covered_by_existing_index_is_not_created(baseline_database):
+    # Like the index InnoDB creates for a foreign key
+    path = baseline_database('CREATE INDEX attendee_poll_fk ON attendee (poll_id);')
+    database = MyDatabase('sqlite:///' + path)
+    assert index_columns(database, 'attendee') == {'attendee_poll_fk': ['poll_id']}
+
+
+def test_concurrent_upgrades_run_once(baseline_database):
+    path = baseline_database()
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def open_database():
+        barrier.wait()
+        try:
+            MyDatabase('sqlite:///' + path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_database) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert schema_versions(path) == [len(MIGRATIONS)]
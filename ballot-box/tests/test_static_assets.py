@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta
+
+from flask import Flask, render_template_string
+
+from static_assets import MAX_AGE, StaticAssets, build
+
+
+def test_assets_are_cached_for_a_year(tmp_path):
+    (tmp_path / 'site.js').write_text('console.log("site");\n' * 100)
+    build(str(tmp_path))
+    app = Flask(__name__, static_folder=str(tmp_path))
+    StaticAssets(app)
+    with app.test_request_context():
+        url = render_template_string("{{ asset_url('site.js') }}")
+    client = app.test_client()
+    for accept_encoding, content_encoding in (('gzip', 'gzip'), ('identity', None)):
+        response = client.get(url, headers={'Accept-Encoding': accept_encoding})
+        assert response.status_code == 200
+        assert response.headers.get('Content-Encoding') == content_encoding
+        assert response.headers['Cache-Control'] == 'public, max-age={}, immutable'.format(MAX_AGE)
+        # Not Flask's default of 12 hours, which would contradict max-age for HTTP/1.0 caches
+        assert response.expires > datetime.utcnow() + timedelta(seconds=MAX_AGE - 3600)
+        response.close()
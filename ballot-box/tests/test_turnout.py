@@ -0,0 +1,147 @@
+import json
+import threading
+
+import pytest
+
+import turnout_stream
+from db import MyDatabaseSession, PollState, PollTurnout, my_session_scope
+from turnout import TooManyPolls, TurnoutMonitor
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('turnout.time.monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Poll ids of every get_turnouts call."""
+    calls = []
+    get_turnouts = MyDatabaseSession.get_turnouts
+
+    def counting_get_turnouts(session, poll_ids):
+        calls.append(sorted(poll_ids))
+        return get_turnouts(session, poll_ids)
+
+    monkeypatch.setattr(MyDatabaseSession, 'get_turnouts', counting_get_turnouts)
+    return calls
+
+
+def test_watchers_share_one_read_per_interval(database, make_poll, clock, reads):
+    monitor = TurnoutMonitor(database, interval=0.5)
+    first, _ = make_poll(['a', 'b'])
+    second, (yes, _, _) = make_poll(['c'])
+    for _ in range(100):
+        assert monitor.get(first) == PollTurnout(PollState.active, 2, 0)
+    assert monitor.get(second) == PollTurnout(PollState.active, 1, 0)
+    assert reads == [[first], [first, second]]
+
+    with my_session_scope(database) as session:
+        session.submit_vote(second, 'c', [yes])
+    assert monitor.get(second).submitted == 0
+    clock[0] += 0.5
+    assert monitor.get(second).submitted == 1
+    assert all(monitor.get(poll_id) for poll_id in (first, second) for _ in range(100))
+    assert reads == [[first], [first, second], [first, second]]
+
+
+def test_concurrent_requests_answer_from_the_snapshot_while_it_is_read(database, make_poll, clock, monkeypatch):
+    monitor = TurnoutMonitor(database, interval=0.5)
+    poll_id, _ = make_poll(['a'])
+    monitor.get(poll_id)
+    clock[0] += 1
+    reading = threading.Event()
+    release = threading.Event()
+    get_turnouts = MyDatabaseSession.get_turnouts
+
+    def slow_get_turnouts(session, poll_ids):
+        reading.set()
+        release.wait(5)
+        return get_turnouts(session, poll_ids)
+
+    monkeypatch.setattr(MyDatabaseSession, 'get_turnouts', slow_get_turnouts)
+    thread = threading.Thread(target=monitor.get, args=(poll_id,))
+    thread.start()
+    assert reading.wait(5)
+    # Answered from the previous read without waiting for the running one
+    assert monitor.get(poll_id) == PollTurnout(PollState.active, 1, 0)
+    release.set()
+    thread.join()
+
+
+def test_idle_polls_are_no_longer_read(database, make_poll, clock, reads):
+    monitor = TurnoutMonitor(database, interval=0.5, idle_timeout=60)
+    first, _ = make_poll(['a'])
+    second, _ = make_poll(['b'])
+    monitor.get(first)
+    clock[0] += 30
+    monitor.get(second)
+    clock[0] += 31
+    monitor.get(second)
+    assert reads == [[first], [first, second], [second]]
+
+
+def test_number_of_watched_polls_is_capped(database, make_poll, clock):
+    monitor = TurnoutMonitor(database, max_polls=2, idle_timeout=60)
+    polls = [make_poll(['a'])[0] for _ in range(3)]
+    monitor.get(polls[0])
+    monitor.get(polls[1])
+    with pytest.raises(TooManyPolls):
+        monitor.get(polls[2])
+    # Watched polls are still answered
+    assert monitor.get(polls[1]) is not None
+    clock[0] += 61
+    assert monitor.get(polls[2]) is not None
+
+
+def read_events(response):
+    """Data of the events sent on a stream until it ends."""
+    body = b''.join(response.response).decode()
+    response.close()
+    return [json.loads(line[len('data: '):]) for line in body.splitlines() if line.startswith('data: ')]
+
+
+def test_turnout_stream_sends_changes_until_the_poll_is_closed(database, make_poll, monkeypatch):
+    monkeypatch.setattr(turnout_stream, 'turnout_monitor', TurnoutMonitor(database, interval=0))
+    poll_id, (yes, _, _) = make_poll(['a', 'b'], ['Ann'])
+    sleeps = []
+
+    def vote_and_close(seconds):
+        sleeps.append(seconds)
+        with my_session_scope(database) as session:
+            if len(sleeps) == 1:
+                session.submit_vote(poll_id, 'a', [yes])
+            elif len(sleeps) == 3:
+                session.close_poll(poll_id)
+
+    monkeypatch.setattr('turnout_stream.time.sleep', vote_and_close)
+    response = turnout_stream.app.test_client().get('/admin/turnout/{}/stream'.format(poll_id), buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    # Unchanged numbers after the second sleep are not sent again
+    assert read_events(response) == [{'state': 'active', 'tokens': 2, 'submitted': 0},
+                                     {'state': 'active', 'tokens': 2, 'submitted': 1},
+                                     {'state': 'closed', 'tokens': 2, 'submitted': 1}]
+    assert len(sleeps) == 3
+
+
+def test_turnout_stream_refusals(database, make_poll, monkeypatch):
+    monkeypatch.setattr(turnout_stream, 'turnout_monitor', TurnoutMonitor(database, max_polls=2))
+    monkeypatch.setattr(turnout_stream, 'open_streams', threading.BoundedSemaphore(1))
+    client = turnout_stream.app.test_client()
+    prepared, _ = make_poll()
+    active, _ = make_poll(['a'])
+    assert client.get('/admin/turnout/999999/stream').status_code == 404
+    response = client.get('/admin/turnout/{}/stream'.format(prepared), buffered=False)
+    # Not activated yet, there are no numbers instead of zeros
+    assert next(event for event in response.response if event.startswith(b'data: ')) == \
+        b'data: {"state": "prepared", "tokens": null, "submitted": null}\n\n'
+    refused = client.get('/admin/turnout/{}/stream'.format(active))
+    assert refused.status_code == 503 and refused.get_json() == {'error': 'too_many_streams'}
+    response.close()
+    client.get('/admin/turnout/{}/stream'.format(active), buffered=False).close()
+    refused = client.get('/admin/turnout/{}/stream'.format(make_poll(['c'])[0]))
+    assert refused.status_code == 503 and refused.get_json() == {'error': 'too_many_polls'}
+    assert refused.headers['Retry-After'] == str(turnout_stream.TURNOUT_RETRY_AFTER)
@@ -0,0 +1,75 @@
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from db import MyDatabase, MyDatabaseSession, PollTurnout, my_session_scope
+
+
+class TooManyPolls(Exception):
+    """Raised instead of watching another poll when max_polls polls are watched already."""
+
+
+class TurnoutMonitor:
+    """Keeps the turnout of the watched polls for the turnout streams.
+
+    The turnout is read from the poll tallies that submit_vote keeps up to date. The stream that finds the snapshot
+    older than interval reads all watched polls in one query, concurrent streams answer from the previous snapshot
+    meanwhile. So the database load does not depend on the number of watchers, and no stream waits longer than one
+    query. A poll is watched until it has not been requested for idle_timeout seconds.
+    """
+
+    def __init__(self, database: MyDatabase, interval: float = 0.5, idle_timeout: float = 60, max_polls: int = 100):
+        self.database = database
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.max_polls = max_polls
+        self._lock = threading.Lock()
+        # Only one request per process reads the tallies at a time
+        self._refresh_lock = threading.Lock()
+        # Time of the last request by watched poll
+        self._requested: Dict[int, float] = {}
+        self._turnouts: Dict[int, PollTurnout] = {}
+        # Polls contained in the last read, polls that do not exist are missing in _turnouts
+        self._read: Set[int] = set()
+        self._read_at = float('-inf')
+
+    def get(self, poll_id: int) -> Optional[PollTurnout]:
+        """Returns the turnout of a poll, at most about interval seconds old, None if the poll does not exist."""
+        now = time.monotonic()
+        with self._lock:
+            for watched_poll_id in [watched_poll_id for watched_poll_id, requested in self._requested.items()
+                                    if now - requested > self.idle_timeout]:
+                del self._requested[watched_poll_id]
+            if poll_id not in self._requested and len(self._requested) >= self.max_polls:
+                raise TooManyPolls()
+            self._requested[poll_id] = now
+            unread = poll_id not in self._read
+            outdated = now - self._read_at >= self.interval
+        if unread:
+            # Nothing to answer from yet, so wait for a read that includes this poll
+            self._refresh(poll_id, blocking=True)
+        elif outdated:
+            self._refresh(poll_id, blocking=False)
+        with self._lock:
+            turnout = self._turnouts.get(poll_id)
+            if turnout is None:
+                self._requested.pop(poll_id, None)
+            return turnout
+
+    def _refresh(self, poll_id: int, blocking: bool):
+        if not self._refresh_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                if poll_id in self._read and time.monotonic() - self._read_at < self.interval:
+                    # Read by another request while this one was waiting
+                    return
+                poll_ids: List[int] = list(self._requested)
+            with my_session_scope(self.database) as session:  # type: MyDatabaseSession
+                turnouts = session.get_turnouts(poll_ids)
+            with self._lock:
+                self._turnouts = turnouts
+                self._read = set(poll_ids)
+                self._read_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+from flask import Flask, Response, abort, jsonify, stream_with_context
+
+from db import MyDatabase, PollState, PollTurnout
+from turnout import TooManyPolls, TurnoutMonitor
+
+# Pushes the turnout to the turnout page and the admin overview as server-sent events. Every open page holds a
+# connection, so this app runs in its own gunicorn process with an eventlet worker instead of taking the threads of
+# the workers that accept ballots: gunicorn -k eventlet -w1 turnout_stream:app
+app = Flask(__name__)
+
+my_database = MyDatabase(os.getenv('DB_URL', 'sqlite:///./db.sqlite'))
+
+# The turnout is read at most every TURNOUT_INTERVAL_MS milliseconds per process for all streams together, for at most
+# TURNOUT_MAX_POLLS polls
+TURNOUT_INTERVAL = float(os.getenv('TURNOUT_INTERVAL_MS', '500')) / 1000
+turnout_monitor = TurnoutMonitor(my_database, TURNOUT_INTERVAL, max_polls=int(os.getenv('TURNOUT_MAX_POLLS', '100')))
+
+# Streams beyond TURNOUT_MAX_STREAMS per process are refused
+open_streams = threading.BoundedSemaphore(int(os.getenv('TURNOUT_MAX_STREAMS', '1000')))
+# Seconds clients wait before opening a stream again after it was refused or lost
+TURNOUT_RETRY_AFTER = 10
+# Seconds after which a comment is sent if the turnout did not change, so connections of closed pages are noticed
+TURNOUT_KEEPALIVE = 15
+
+
+def turnout_event(turnout: PollTurnout) -> str:
+    return 'data: {}\n\n'.format(json.dumps({'state': turnout.state.name,
+                                             'tokens': turnout.tokens,
+                                             'submitted': turnout.submitted}))
+
+
+def turnout_events(poll_id: int, turnout: PollTurnout):
+    """Sends the turnout whenever it changed until the poll is closed."""
+    yield 'retry: {}\n\n'.format(TURNOUT_RETRY_AFTER * 1000)
+    sent = None
+    sent_at = time.monotonic()
+    while True:
+        if turnout != sent:
+            yield turnout_event(turnout)
+            sent, sent_at = turnout, time.monotonic()
+        elif time.monotonic() - sent_at >= TURNOUT_KEEPALIVE:
+            yield ': keepalive\n\n'
+            sent_at = time.monotonic()
+        if turnout.state == PollState.closed:
+            return
+        time.sleep(TURNOUT_INTERVAL)
+        try:
+            turnout = turnout_monitor.get(poll_id)
+        except TooManyPolls:
+            # The poll was not requested for longer than the idle timeout, the client opens the stream again later
+            return
+        if turnout is None:
+            return
+
+
+def unavailable(error: str):
+    response = jsonify(error=error)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(TURNOUT_RETRY_AFTER)
+    return response
+
+
+@app.route('/admin/turnout/<int:poll_id>/stream')
+def turnout_stream(poll_id):
+    """Number of issued tokens and submitted ballots, shown by the turnout page and the admin overview."""
+    try:
+        turnout = turnout_monitor.get(poll_id)
+    except TooManyPolls:
+        return unavailable('too_many_polls')
+    if turnout is None:
+        abort(404)
+    if not open_streams.acquire(blocking=False):
+        return unavailable('too_many_streams')
+    response = Response(stream_with_context(turnout_events(poll_id, turnout)), mimetype='text/event-stream')
+    response.call_on_close(open_streams.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keeps a buffering reverse proxy from holding back the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
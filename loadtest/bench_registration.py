@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Micro-benchmark of registrations in the in-process state backend of vote-registration.
+
+Registers N voters in one registration session and reports the mean time per registration and per status snapshot
+for growing N. With the indexed registration store both stay flat instead of growing with the number of registrants.
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vote-registration'))
+
+from state_backend import InProcessStateBackend  # noqa: E402
+
+SESSION = 'bench'
+
+
+def bench(registrants: int, snapshots: int):
+    backend = InProcessStateBackend(max_login_sessions=registrants)
+    backend.start_registration(SESSION, 'Benchmark', 'http://localhost/1')
+    start = time.perf_counter()
+    for i in range(registrants):
+        backend.register(SESSION, 'user{}'.format(i), 'User {}'.format(i), 'sid{}'.format(i))
+        backend.is_registered(SESSION, 'user{}'.format(i))
+    register_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(snapshots):
+        backend.get_registration_status(SESSION)
+    snapshot_time = time.perf_counter() - start
+    return register_time / registrants, snapshot_time / snapshots
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--registrants', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--snapshots', type=int, default=1000, help='status snapshots taken after registering')
+    args = parser.parse_args(argv)
+    print('{:>12} {:>18} {:>18}'.format('registrants', 'register [us]', 'snapshot [us]'))
+    for registrants in args.registrants:
+        register_time, snapshot_time = bench(registrants, args.snapshots)
+        print('{:>12} {:>18.2f} {:>18.2f}'.format(registrants, register_time * 1e6, snapshot_time * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
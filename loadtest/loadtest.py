@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""Simulates a full voting cycle against locally running services.
+
+vote-registration has to run in local mode (see README). The script logs in N voters through the local login form,
+connects and registers them via Socket.IO, ends the registration as admin, activates a new ballot-box poll with the
+issued tokens and finally submits one ballot per voter. Latencies and throughput are reported per phase.
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+import socketio
+
+NAMESPACE = '/test'
+TOKEN_PATTERN = re.compile(r'const secret_voting_token = "([^"]+)"')
+POLL_ID_PATTERN = re.compile(r'\(ID (\d+)\)')
+PHASES = ['login', 'connect', 'register', 'voting_end', 'activate', 'submit']
+
+
+class PhaseResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.duration = 0.0
+        self.lock = threading.Lock()
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def throughput(self) -> float:
+        return len(self.latencies) / self.duration if self.duration > 0 else 0.0
+
+    def to_dict(self) -> Dict:
+        return {'count': len(self.latencies),
+                'errors': self.errors,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'throughput': self.throughput()}
+
+
+class SimulatedClient:
+    """A browser session of vote-registration with its Socket.IO connection."""
+
+    def __init__(self, base_url: str, userid: str, fullname: str, relay_state: str = '', is_admin: bool = False):
+        self.base_url = base_url
+        self.userid = userid
+        self.fullname = fullname
+        self.relay_state = relay_state
+        self.is_admin = is_admin
+        self.login_token = None
+        self.display_token = None
+        self.voting_end_response = None
+        self.sio = socketio.Client(reconnection=False)
+        self.initial_status = threading.Event()
+        self.register_response = threading.Event()
+        self.registered = False
+        self.generated_token = threading.Event()
+        self.voting_ended = threading.Event()
+        self.registration_reset = threading.Event()
+        self.sio.on('initial_status', lambda _: self.initial_status.set(), namespace=NAMESPACE)
+        self.sio.on('reset_broadcast', lambda _: self.registration_reset.set(), namespace=NAMESPACE)
+        self.sio.on('register_response', self._on_register_response, namespace=NAMESPACE)
+        self.sio.on('generated_token', self._on_generated_token, namespace=NAMESPACE)
+        self.sio.on('voting_end_response', self._on_voting_end_response, namespace=NAMESPACE)
+
+    def _on_register_response(self, msg):
+        self.registered = msg['successful']
+        self.register_response.set()
+
+    def _on_generated_token(self, msg):
+        self.display_token = msg['token']
+        self.generated_token.set()
+
+    def _on_voting_end_response(self, msg):
+        self.voting_end_response = msg
+        self.voting_ended.set()
+
+    def login(self):
+        form = {'RelayState': self.relay_state, 'fullname': self.fullname, 'userid': self.userid, 'is_voting': 'on'}
+        if self.is_admin:
+            form['is_admin'] = 'on'
+        response = requests.post(self.base_url + '/', data=form)
+        response.raise_for_status()
+        match = TOKEN_PATTERN.search(response.text)
+        if match is None:
+            raise RuntimeError('No login token in response for ' + self.userid)
+        self.login_token = match.group(1)
+
+    def connect(self, timeout: float):
+        self.sio.connect(self.base_url + '?token=' + self.login_token, namespaces=[NAMESPACE])
+        if not self.initial_status.wait(timeout):
+            raise RuntimeError('No initial_status for ' + self.userid)
+
+    def register(self, timeout: float):
+        self.sio.emit('voting_register', {}, namespace=NAMESPACE)
+        if not self.register_response.wait(timeout) or not self.registered:
+            raise RuntimeError('Registration failed for ' + self.userid)
+
+    def close(self):
+        if self.sio.connected:
+            self.sio.disconnect()
+
+
+def run_phase(result: PhaseResult, items: List, action: Callable, concurrency: int):
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            action(item)
+        except Exception as e:
+            print('{}: {}'.format(result.name, e), file=sys.stderr)
+            with result.lock:
+                result.errors += 1
+            return
+        with result.lock:
+            result.latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, items))
+    result.duration = time.perf_counter() - start
+
+
+def run(args) -> Dict[str, PhaseResult]:
+    results = {name: PhaseResult(name) for name in PHASES}
+    run_id = str(int(time.time()))
+    voters = [SimulatedClient(args.registration_url, 'loadtest-{}-{}'.format(run_id, i), 'Voter {}'.format(i))
+              for i in range(args.voters)]
+    admin = SimulatedClient(args.registration_url, 'loadtest-{}-admin'.format(run_id), 'Admin', 'admin', True)
+    ballot_box = requests.Session()
+    activated = {}
+    try:
+        admin.login()
+        admin.connect(args.timeout)
+        admin.sio.emit('admin_voting_start', {'voting_title': 'Load test ' + run_id,
+                                              'voting_link': args.ballot_box_url}, namespace=NAMESPACE)
+        if not admin.registration_reset.wait(args.timeout):
+            raise RuntimeError('Registration could not be started')
+
+        run_phase(results['login'], voters, lambda voter: voter.login(), args.concurrency)
+        logged_in = [voter for voter in voters if voter.login_token]
+        run_phase(results['connect'], logged_in, lambda voter: voter.connect(args.timeout), args.concurrency)
+        connected = [voter for voter in logged_in if voter.sio.connected]
+        run_phase(results['register'], connected, lambda voter: voter.register(args.timeout), args.concurrency)
+
+        def end_voting(_):
+            admin.sio.emit('admin_voting_end', {}, namespace=NAMESPACE)
+            if not admin.voting_ended.wait(args.timeout):
+                raise RuntimeError('No voting_end_response')
+
+        run_phase(results['voting_end'], [None], end_voting, 1)
+        if admin.voting_end_response is None:
+            return results
+
+        def activate(_):
+            response = ballot_box.post(args.ballot_box_url + '/admin/new_poll',
+                                       data={'label': 'Load test ' + run_id, 'type': 'singleVote',
+                                             'answer[]': ['Yes', 'No']})
+            response.raise_for_status()
+            poll_id = POLL_ID_PATTERN.search(response.text).group(1)
+            if args.api_token:
+                # Streamed with chunked transfer encoding like vote-registration does with BALLOT_BOX_URL
+                rows = [{'token': token} for token in admin.voting_end_response['all_tokens']] \
+                    + [{'attendee': name} for name in admin.voting_end_response['all_users']]
+                response = ballot_box.post(args.ballot_box_url + '/api/activate_poll/' + poll_id,
+                                           data=(json.dumps(row).encode('utf-8') + b'\n' for row in rows),
+                                           headers={'Authorization': 'Bearer ' + args.api_token,
+                                                    'Content-Type': 'application/x-ndjson'})
+                response.raise_for_status()
+            else:
+                tokens = {'tokens': admin.voting_end_response['all_tokens'],
+                          'users': admin.voting_end_response['all_users']}
+                response = ballot_box.post(args.ballot_box_url + '/admin/activate_poll/' + poll_id,
+                                           data={'tokens': json.dumps(tokens)})
+                response.raise_for_status()
+                if 'alert-success' not in response.text:
+                    raise RuntimeError('Poll could not be activated')
+            activated['poll_id'] = poll_id
+
+        run_phase(results['activate'], [None], activate, 1)
+        if 'poll_id' not in activated:
+            return results
+        poll_id = activated['poll_id']
+        answer_ids = re.findall(r'name="answer" class="form-check-input"\s+value="(\d+)"',
+                                ballot_box.get(args.ballot_box_url + '/' + poll_id).text)
+
+        def submit(token):
+            response = requests.post(args.ballot_box_url + '/' + poll_id + '/submit_vote',
+                                     data={'token': token, 'answer': answer_ids[:1]})
+            response.raise_for_status()
+            if 'alert-success' not in response.text:
+                raise RuntimeError('Ballot was not accepted')
+
+        for voter in connected:
+            voter.generated_token.wait(args.timeout)
+        run_phase(results['submit'], admin.voting_end_response['all_tokens'], submit, args.concurrency)
+        ballot_box.get(args.ballot_box_url + '/admin/close_poll/' + poll_id)
+    finally:
+        for client in voters + [admin]:
+            client.close()
+    return results
+
+
+def compare_with_baseline(results: Dict[str, PhaseResult], baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        current = result.to_dict()
+        if current['errors'] > baseline[name]['errors']:
+            regressions.append('{}: {} errors, baseline {}'.format(name, current['errors'], baseline[name]['errors']))
+        if current['p95'] > baseline[name]['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.4f}s, baseline {:.4f}s'.format(name, current['p95'],
+                                                                          baseline[name]['p95']))
+        if current['throughput'] < baseline[name]['throughput'] * (1 - tolerance):
+            regressions.append('{}: throughput {:.1f}/s, baseline {:.1f}/s'.format(
+                name, current['throughput'], baseline[name]['throughput']))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--registration-url', default='http://localhost:5001')
+    parser.add_argument('--ballot-box-url', default='http://localhost:5002')
+    parser.add_argument('--voters', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for a Socket.IO response')
+    parser.add_argument('--api-token', help='activate the poll through the ballot-box API with this token')
+    parser.add_argument('--baseline', help='JSON file with the results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print('{:<12}{:>8}{:>8}{:>10}{:>10}{:>10}{:>12}'.format('phase', 'count', 'errors', 'p50', 'p95', 'p99',
+                                                           'per second'))
+    for result in results.values():
+        values = result.to_dict()
+        print('{:<12}{:>8}{:>8}{:>10.4f}{:>10.4f}{:>10.4f}{:>12.1f}'.format(
+            result.name, values['count'], values['errors'], values['p50'], values['p95'], values['p99'],
+            values['throughput']))
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({name: result.to_dict() for name, result in results.items()}, f, indent=2, sort_keys=True)
+        return 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if any(result.errors for result in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,39 @@
 #!/usr/bin/env python
 
 import os
-import random
+import re
+import secrets
 import string
-from threading import Lock
 from urllib.parse import urlparse
 
-from flask import Flask, make_response, redirect, render_template, request
-from flask_socketio import SocketIO, emit, close_room, disconnect
+from flask import Flask, abort, make_response, redirect, render_template, request
+from flask_socketio import SocketIO, emit, join_room
 from flask_babel import Babel
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
 
+from ballot_box_client import BallotBoxClient
+from metrics import CONNECTED_SOCKETS, REGISTRATIONS, instrument_app, observe_event
+from registration_broadcast import RegistrationBroadcaster
+from resume_credentials import ResumeCredentials
+from saml_settings import SamlSettingsCache
+from static_assets import StaticAssets
+from state_backend import SamlReturnData, create_state_backend, DEFAULT_REGISTRATION_SESSION, ROLE_ADMIN, \
+    ROLE_PRESENTER, ROLE_VOTER, ROLES
+
 app = Flask(__name__)
 
 SAML_CONFIG_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 # async_mode=None leaves it to the application to choose the best option based on installed packages.
-socketio = SocketIO(app, async_mode=None)
+# A message queue is needed if several workers share a state backend, so broadcasts reach clients on every worker.
+socketio = SocketIO(app, async_mode=None, message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE'))
 
 babel = Babel(app)
 
+# Fingerprinted assets built by static_assets.py, templates link them with asset_url()
+static_assets = StaticAssets(app)
+
+instrument_app(app)
+
 app.config['LANGUAGES'] = [
     'de',
     'en',
@@ -26,36 +41,68 @@ app.config['LANGUAGES'] = [
     'fr'
 ]
 
-admins = []
-session_userids = {}
-session_fullnames = {}
-session_is_voting = {}
-login_sessions = {}
+# Sockets can reconnect without a new login within RESUME_TTL seconds after they received their last credential.
+# Several workers need to share RESUME_SECRET_KEY, otherwise a random key is used.
+RESUME_TTL = float(os.getenv('RESUME_TTL', '600'))
+resume_credentials = ResumeCredentials(os.getenv('RESUME_SECRET_KEY') or secrets.token_urlsafe(32), RESUME_TTL)
 
+# Login tokens that are not used by a socket within LOGIN_SESSION_TTL seconds expire
+state = create_state_backend(os.getenv('STATE_BACKEND_URL'),
+                             login_session_ttl=float(os.getenv('LOGIN_SESSION_TTL', '300')),
+                             max_login_sessions=int(os.getenv('MAX_LOGIN_SESSIONS', '10000')),
+                             pending_token_ttl=RESUME_TTL)
 
-class SamlReturnData:
-    votingStatus = False
-    adminStatus = False
-    presenterStatus = False
-    userid = ""
-    fullname = ""
+# Set SAML_SETTINGS_RELOAD_INTERVAL to a number of seconds to pick up changes of settings.json and the certificates
+saml_settings = SamlSettingsCache(SAML_CONFIG_DIRECTORY, float(os.getenv('SAML_SETTINGS_RELOAD_INTERVAL', '0')))
 
+# Independent groups use separate registration sessions, selected by ?session=<id> on the entry pages
+REGISTRATION_SESSION_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
 
-class VoteRegistrationData:
-    registration_active = False
-    registered_fullnames = []
-    registered_userids = []
-    registered_sessionids = []
-    voting_title = ""
-    voting_link = ""
+# Every socket joins the room of its registration session. The voter, admin and presenter pages all render the
+# registration events, so they are sent once to that room instead of once per page.
+def session_room(session_id):
+    return 'session:' + session_id
 
 
-vote_registration_data: VoteRegistrationData = VoteRegistrationData()
-vote_registration_lock = Lock()
+# Registrations within REGISTER_BROADCAST_INTERVAL_MS are sent to the clients in one event, 0 sends them one by one
+registration_broadcaster = RegistrationBroadcaster(socketio, '/test', session_room,
+                                                   float(os.getenv('REGISTER_BROADCAST_INTERVAL_MS', '100')) / 1000)
+
+# If BALLOT_BOX_URL and BALLOT_BOX_API_TOKEN are set, polls of that ballot box given as voting link are activated with
+# the generated tokens when the registration ends. BALLOT_BOX_API_URL can point to an internal address of it.
+if os.getenv('BALLOT_BOX_URL') and os.getenv('BALLOT_BOX_API_TOKEN'):
+    ballot_box_client = BallotBoxClient(os.getenv('BALLOT_BOX_URL'), os.getenv('BALLOT_BOX_API_TOKEN'),
+                                        os.getenv('BALLOT_BOX_API_URL'))
+else:
+    ballot_box_client = None
+
+# Number of tokens sent out in admin_voting_end before yielding to other greenlets
+TOKEN_ISSUE_BATCH_SIZE = int(os.getenv('TOKEN_ISSUE_BATCH_SIZE', '50'))
 
 
 def init_saml_auth(req):
-    return OneLogin_Saml2_Auth(req, custom_base_path=SAML_CONFIG_DIRECTORY)
+    return OneLogin_Saml2_Auth(req, old_settings=saml_settings.get())
+
+
+def requested_registration_session():
+    session_id = request.args.get('session', DEFAULT_REGISTRATION_SESSION)
+    if not REGISTRATION_SESSION_PATTERN.match(session_id):
+        abort(404)
+    return session_id
+
+
+def make_relay_state(role, session_id):
+    return '{}:{}'.format(role, session_id)
+
+
+def parse_relay_state(relay_state):
+    """Returns role and registration session, other relay states (e.g. URLs) mean the voter page."""
+    role, _, session_id = relay_state.partition(':')
+    if role not in ROLES:
+        return ROLE_VOTER, DEFAULT_REGISTRATION_SESSION
+    if not REGISTRATION_SESSION_PATTERN.match(session_id):
+        session_id = DEFAULT_REGISTRATION_SESSION
+    return role, session_id
 
 
 def prepare_flask_request(request_data):
@@ -74,11 +121,12 @@ def prepare_flask_request(request_data):
 
 @app.route('/', methods=['GET'])
 def sso():
+    relay_state = make_relay_state(ROLE_VOTER, requested_registration_session())
+    if saml_settings.local_mode():
+        return render_template('local.html', RelayState=relay_state)
     req = prepare_flask_request(request)
     auth = init_saml_auth(req)
-    if auth.get_settings().get_security_data().get('localMode', False):
-        return render_template('local.html', RelayState="")
-    return redirect(auth.login())
+    return redirect(auth.login(relay_state))
 
 
 @app.route('/', methods=['POST'])
@@ -88,8 +136,9 @@ def acs():
 
     token = generate_token()
     saml_return_data = SamlReturnData()
+    role, saml_return_data.registration_session = parse_relay_state(request.form.get('RelayState', ''))
 
-    local_mode = auth.get_settings().get_security_data().get('localMode', False)
+    local_mode = saml_settings.local_mode()
     if local_mode:
         # Local Mode is active, do not check SAML login data
         saml_return_data.fullname = request.form.get('fullname')
@@ -112,38 +161,47 @@ def acs():
         saml_return_data.adminStatus = attributes.get('is_admin', False)
         saml_return_data.presenterStatus = attributes.get('is_presenter', False)
 
-    login_sessions[token] = saml_return_data
-
-    if 'RelayState' in request.form and request.form['RelayState'] == 'admin':
+    if role == ROLE_ADMIN:
         if not saml_return_data.adminStatus:
             return render_template("message.html", msg="no_admin_permissions")
-        return render_template('admin.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode)
-    elif 'RelayState' in request.form and request.form['RelayState'] == 'presenter':
+        saml_return_data.role = ROLE_ADMIN
+        state.store_login_session(token, saml_return_data)
+        return render_template('admin.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode,
+                               registration_session=saml_return_data.registration_session)
+    elif role == ROLE_PRESENTER:
         if not saml_return_data.presenterStatus:
             return render_template("message.html", msg="no_presenter_permissions")
-        return render_template('presenter.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode)
+        saml_return_data.role = ROLE_PRESENTER
+        state.store_login_session(token, saml_return_data)
+        return render_template('presenter.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode,
+                               registration_session=saml_return_data.registration_session)
     else:
         if not saml_return_data.votingStatus:
             return render_template("message.html", msg="no_voting_permissions")
-        return render_template('index.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode)
+        saml_return_data.role = ROLE_VOTER
+        state.store_login_session(token, saml_return_data)
+        return render_template('index.html', async_mode=socketio.async_mode, token=token, local_mode=local_mode,
+                               registration_session=saml_return_data.registration_session)
 
 
 @app.route('/admin', methods=['GET'])
 def admin():
+    relay_state = make_relay_state(ROLE_ADMIN, requested_registration_session())
+    if saml_settings.local_mode():
+        return render_template('local.html', RelayState=relay_state)
     req = prepare_flask_request(request)
     auth = init_saml_auth(req)
-    if auth.get_settings().get_security_data().get('localMode', False):
-        return render_template('local.html', RelayState='admin')
-    return redirect(auth.login('admin'))
+    return redirect(auth.login(relay_state))
 
 
 @app.route('/presenter', methods=['GET'])
 def presenter():
+    relay_state = make_relay_state(ROLE_PRESENTER, requested_registration_session())
+    if saml_settings.local_mode():
+        return render_template('local.html', RelayState=relay_state)
     req = prepare_flask_request(request)
     auth = init_saml_auth(req)
-    if auth.get_settings().get_security_data().get('localMode', False):
-        return render_template('local.html', RelayState='presenter')
-    return redirect(auth.login('presenter'))
+    return redirect(auth.login(relay_state))
 
 
 @app.route('/slo')
@@ -162,141 +220,212 @@ def sls():
 
 @app.route('/metadata')
 def metadata():
-    req = prepare_flask_request(request)
-    auth = init_saml_auth(req)
-    settings = auth.get_settings()
-    sp_metadata = settings.get_sp_metadata()
-    errors = settings.validate_metadata(sp_metadata)
+    sp_metadata, etag, errors = saml_settings.sp_metadata()
 
     if len(errors) > 0:
         return make_response(', '.join(errors), 500)
 
     resp = make_response(sp_metadata, 200)
     resp.headers['Content-Type'] = 'text/xml'
-    return resp
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 
 @socketio.on('voting_register', namespace='/test')
+@observe_event('voting_register')
 def voting_register(_):
-    if not vote_registration_data.registration_active:
+    saml_return_data = state.get_socket_session(request.sid)
+    session_id = saml_return_data.registration_session
+    fullname = saml_return_data.fullname
+    registration = state.register(session_id, saml_return_data.userid, fullname, request.sid)
+    if registration is None:
         emit('register_response',
              {'successful': False})
         return
-    fullname = session_fullnames[request.sid]
-    userid = session_userids[request.sid]
-    with vote_registration_lock:
-        if userid in vote_registration_data.registered_userids:
-            emit('register_response',
-                 {'successful': False})
-            return
-        vote_registration_data.registered_fullnames.append(fullname)
-        vote_registration_data.registered_userids.append(userid)
-        vote_registration_data.registered_sessionids.append(request.sid)
-        vote_registration_data.registered_sessionids.sort()
-        del session_userids[request.sid]
-        del session_fullnames[request.sid]
+    registration_round, registration_seq = registration
+    REGISTRATIONS.labels(session_id).set(registration_seq)
     emit('register_response',
          {'successful': True})
-    emit('register_broadcast',
-         {'name': fullname,
-          'registered_fullnames': vote_registration_data.registered_fullnames},
-         broadcast=True)
+    # Only the new name is sent, clients request a resync if they notice a gap in the sequence
+    registration_broadcaster.add(session_id, registration_round, registration_seq, fullname)
+
+
+@socketio.on('registration_resync', namespace='/test')
+@observe_event('registration_resync')
+def registration_resync(_):
+    saml_return_data = state.get_socket_session(request.sid)
+    registration_status = state.get_registration_status(saml_return_data.registration_session)
+    emit('registration_snapshot',
+         {'registered_fullnames': registration_status.registered_fullnames,
+          'round': registration_status.registration_round,
+          'seq': registration_status.registration_seq})
 
 
 @socketio.on('admin_voting_reset', namespace='/test')
+@observe_event('admin_voting_reset')
 def admin_voting_reset(_):
-    if request.sid not in admins:
+    if not state.is_admin(request.sid):
         return
-    with vote_registration_lock:
-        vote_registration_data.registration_active = True
-        vote_registration_data.registered_fullnames.clear()
-        vote_registration_data.registered_userids.clear()
-        vote_registration_data.registered_sessionids.clear()
+    session_id = state.get_socket_session(request.sid).registration_session
+    registration_round = state.start_registration(session_id)
+    REGISTRATIONS.labels(session_id).set(0)
+    registration_broadcaster.clear(session_id)
     emit('reset_broadcast',
-         {},
-         broadcast=True)
+         {'round': registration_round},
+         room=session_room(session_id))
 
 
 @socketio.on('admin_voting_start', namespace='/test')
+@observe_event('admin_voting_start')
 def admin_voting_start(message):
-    if request.sid not in admins:
+    if not state.is_admin(request.sid):
         return
-    with vote_registration_lock:
-        vote_registration_data.registration_active = True
-        vote_registration_data.registered_fullnames.clear()
-        vote_registration_data.registered_userids.clear()
-        vote_registration_data.registered_sessionids.clear()
-        vote_registration_data.voting_title = message['voting_title']
-        vote_registration_data.voting_link = message['voting_link']
+    session_id = state.get_socket_session(request.sid).registration_session
+    registration_round = state.start_registration(session_id, message['voting_title'], message['voting_link'])
+    REGISTRATIONS.labels(session_id).set(0)
+    registration_broadcaster.clear(session_id)
     emit('reset_broadcast',
-         {'voting_title': vote_registration_data.voting_title},
-         broadcast=True)
+         {'round': registration_round,
+          'voting_title': message['voting_title']},
+         room=session_room(session_id))
 
 
 @socketio.on('admin_voting_end', namespace='/test')
+@observe_event('admin_voting_end')
 def admin_voting_end(_):
-    if request.sid not in admins:
+    if not state.is_admin(request.sid):
         return
-    if not vote_registration_data.registration_active:
+    session_id = state.get_socket_session(request.sid).registration_session
+    ended_registration = state.end_registration(session_id)
+    if ended_registration is None:
         return
+    sessions = ended_registration.sessions
+    voting_link = ended_registration.voting_link
+    generated_tokens = generate_display_tokens(len(sessions))
+    # The final sequence number lets clients that missed a delta fetch the complete list
     emit('voting_end_broadcast',
-         {},
-         broadcast=True)
-    with vote_registration_lock:
-        vote_registration_data.registration_active = False
-        generated_tokens = []
-        for sid in vote_registration_data.registered_sessionids:
-            token = generate_display_token()
-            generated_tokens.append(token)
-            generated_tokens.sort()
-            emit('generated_token',
-                 {'token': token,
-                  'voting_link': vote_registration_data.voting_link},
-                 room=sid)
-            close_room(sid)
-            disconnect(sid=sid)
-        vote_registration_data.registered_sessionids.clear()
+         {'round': ended_registration.registration_round,
+          'seq': ended_registration.registration_seq},
+         room=session_room(session_id))
+    # Send out the tokens in batches and yield regularly so other clients are served meanwhile
+    for i, ((userid, sid), token) in enumerate(zip(sessions, generated_tokens)):
+        # A dead socket counts as connected until its ping timeout, so every token is kept until the client
+        # acknowledges it and sent again when the user resumes the session
+        state.store_pending_token(session_id, userid, token, voting_link)
+        if state.get_socket_session(sid) is not None:
+            send_token(session_id, userid, sid, token, voting_link)
+        if (i + 1) % TOKEN_ISSUE_BATCH_SIZE == 0:
+            socketio.sleep(0)
     emit('voting_end_response',
-         {'all_users': vote_registration_data.registered_fullnames,
-          'all_tokens': generated_tokens})
+         {'all_users': ended_registration.registered_fullnames,
+          'all_tokens': sorted(generated_tokens)})
+    poll_id = ballot_box_client.poll_id_for(voting_link) if ballot_box_client is not None else None
+    if poll_id is not None:
+        socketio.start_background_task(activate_ballot_box_poll, request.sid, poll_id, sorted(generated_tokens),
+                                       list(ended_registration.registered_fullnames))
+
+
+def send_token(session_id, userid, sid, token, voting_link):
+    # Flask-SocketIO runs callbacks in the request context of the emitting socket and drops them once that socket is
+    # gone. Tokens are sent while handling the admin's event, so the plain server is used and the callback does not
+    # depend on the admin staying connected.
+    def acknowledged(*_):
+        state.ack_pending_token(session_id, userid, token)
+        socketio.server.close_room(sid, namespace='/test')
+        socketio.server.disconnect(sid, namespace='/test')
+
+    socketio.server.emit('generated_token',
+                         {'token': token,
+                          'voting_link': voting_link},
+                         room=sid, namespace='/test', callback=acknowledged)
+
+
+def activate_ballot_box_poll(admin_sid, poll_id, tokens, attendees):
+    try:
+        ballot_box_client.activate_poll(poll_id, tokens, attendees)
+        successful = True
+    except (OSError, ValueError) as e:
+        # URLError and HTTPError are subclasses of OSError
+        app.logger.warning("Could not activate poll %s in ballot box: %s", poll_id, e)
+        successful = False
+    socketio.emit('ballot_box_activation_response',
+                  {'successful': successful,
+                   'poll_id': poll_id},
+                  room=admin_sid, namespace='/test')
 
 
 @socketio.on('connect', namespace='/test')
+@observe_event('connect')
 def connect():
-    global admins
-    token = request.args.get('token')
-    saml_return_data: SamlReturnData = login_sessions[token]
-    del login_sessions[token]
+    resume = request.args.get('resume')
+    if resume:
+        saml_return_data = resume_credentials.load(resume)
+    else:
+        saml_return_data = state.pop_login_session(request.args.get('token'))
+    if saml_return_data is None:
+        return False
+    CONNECTED_SOCKETS.inc()
     if saml_return_data.adminStatus:
-        admins.append(request.sid)
+        state.add_admin(request.sid)
         admin_state = True
     else:
         admin_state = False
-    with vote_registration_lock:
-        session_userids[request.sid] = saml_return_data.userid
-        session_fullnames[request.sid] = saml_return_data.fullname
-        session_is_voting[request.sid] = saml_return_data.votingStatus
-        if saml_return_data.userid in vote_registration_data.registered_userids:
-            already_registered = True
-        else:
-            already_registered = False
-        emit('initial_status',
-             {'registration_active': vote_registration_data.registration_active,
-              'registered_fullnames': vote_registration_data.registered_fullnames,
-              'already_registered': already_registered,
-              'voting_title': vote_registration_data.voting_title,
-              'fullname': saml_return_data.fullname,
-              'admin_state': admin_state})
+    state.store_socket_session(request.sid, saml_return_data)
+    session_id = saml_return_data.registration_session
+    join_room(session_room(session_id))
+    if resume:
+        state.rebind_registration(session_id, saml_return_data.userid, request.sid)
+    already_registered = state.is_registered(session_id, saml_return_data.userid)
+    registration_status = state.get_registration_status(session_id)
+    emit('initial_status',
+         {'registration_active': registration_status.registration_active,
+          'registered_fullnames': registration_status.registered_fullnames,
+          'registration_round': registration_status.registration_round,
+          'registration_seq': registration_status.registration_seq,
+          'already_registered': already_registered,
+          'voting_title': registration_status.voting_title,
+          'fullname': saml_return_data.fullname,
+          'admin_state': admin_state,
+          'resume': resume_credentials.issue(saml_return_data),
+          'resume_ttl': RESUME_TTL})
+    if resume:
+        pending_token = state.get_pending_token(session_id, saml_return_data.userid)
+        if pending_token is not None:
+            token, voting_link = pending_token
+            send_token(session_id, saml_return_data.userid, request.sid, token, voting_link)
+
+
+@socketio.on('resume_refresh', namespace='/test')
+@observe_event('resume_refresh')
+def resume_refresh(_):
+    saml_return_data = state.get_socket_session(request.sid)
+    if saml_return_data is None:
+        return
+    emit('resume_credential',
+         {'resume': resume_credentials.issue(saml_return_data)})
+
+
+@socketio.on('disconnect', namespace='/test')
+def socket_disconnect():
+    CONNECTED_SOCKETS.dec()
+    state.remove_socket_session(request.sid)
 
 
 def generate_token():
     letters_and_digits = string.ascii_letters + string.digits
-    return ''.join(random.choice(letters_and_digits) for _ in range(50))
+    return ''.join(secrets.choice(letters_and_digits) for _ in range(50))
 
 
 def generate_display_token():
     letters_and_digits = string.ascii_letters + string.digits
-    return ''.join(random.choice(letters_and_digits) for _ in range(8))
+    return ''.join(secrets.choice(letters_and_digits) for _ in range(8))
+
+
+def generate_display_tokens(count):
+    tokens = set()
+    while len(tokens) < count:
+        tokens.add(generate_display_token())
+    return list(tokens)
 
 @babel.localeselector
 def get_locale():
@@ -0,0 +1,44 @@
+import json
+import urllib.request
+from typing import Dict, Iterator, Optional, Sequence
+
+
+class BallotBoxClient:
+    """Activates ballot-box polls with the tokens of an ended registration.
+
+    Tokens and attendees are sent as NDJSON with chunked transfer encoding, so ballot-box stores them while they
+    arrive. Only voting links below base_url are activated, so the API token is never sent to another host. The API
+    is called at api_url, which defaults to base_url and can be an internal address of the same ballot box.
+    """
+
+    def __init__(self, base_url: str, api_token: str, api_url: Optional[str] = None, timeout: float = 60,
+                 lines_per_chunk: int = 500):
+        self.base_url = base_url.rstrip('/')
+        self.api_url = (api_url or base_url).rstrip('/')
+        self.api_token = api_token
+        self.timeout = timeout
+        self.lines_per_chunk = lines_per_chunk
+
+    def poll_id_for(self, voting_link: str) -> Optional[str]:
+        """Returns the poll id of a voting link like <base_url>/<poll_id>, None for other links."""
+        prefix = self.base_url + '/'
+        if not voting_link.startswith(prefix):
+            return None
+        poll_id = voting_link[len(prefix):].strip('/')
+        return poll_id if poll_id.isdigit() else None
+
+    def _ndjson_chunks(self, tokens: Sequence[str], attendees: Sequence[str]) -> Iterator[bytes]:
+        rows = [json.dumps({'token': token}) for token in tokens] \
+            + [json.dumps({'attendee': name}, ensure_ascii=False) for name in attendees]
+        for i in range(0, len(rows), self.lines_per_chunk):
+            yield ''.join(row + '\n' for row in rows[i:i + self.lines_per_chunk]).encode('utf-8')
+
+    def activate_poll(self, poll_id: str, tokens: Sequence[str], attendees: Sequence[str]) -> Dict:
+        """Returns the response of ballot-box, raises urllib.error.URLError if the poll could not be activated."""
+        request = urllib.request.Request(self.api_url + '/api/activate_poll/' + poll_id,
+                                         data=self._ndjson_chunks(tokens, attendees),
+                                         headers={'Authorization': 'Bearer ' + self.api_token,
+                                                  'Content-Type': 'application/x-ndjson'},
+                                         method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
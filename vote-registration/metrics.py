@@ -0,0 +1,62 @@
+import time
+from functools import wraps
+
+from flask import Flask, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+REQUEST_LATENCY = Histogram('vote_registration_request_duration_seconds', 'Latency of HTTP requests', ['endpoint'])
+EVENT_LATENCY = Histogram('vote_registration_event_duration_seconds', 'Latency of Socket.IO event handlers',
+                          ['event'])
+LOCK_WAIT = Histogram('vote_registration_lock_wait_seconds', 'Time spent waiting for vote_registration_lock',
+                      buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5))
+LOCK_HOLD = Histogram('vote_registration_lock_hold_seconds', 'Time vote_registration_lock is held',
+                      buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5))
+CONNECTED_SOCKETS = Gauge('vote_registration_connected_sockets', 'Connected Socket.IO clients of this process')
+REGISTRATIONS = Gauge('vote_registration_registrations', 'Users registered for the current voting', ['session'])
+
+
+class InstrumentedLock:
+    """Wraps a lock and records how long it is waited for and held."""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        LOCK_WAIT.observe(self._acquired_at - start)
+        return self
+
+    def __exit__(self, *_):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        LOCK_HOLD.observe(held)
+
+
+def observe_event(name):
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            with EVENT_LATENCY.labels(name).time():
+                return handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_app(app: Flask):
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start_time = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        if 'metrics_start_time' in g:
+            REQUEST_LATENCY.labels(request.endpoint or 'unknown')\
+                .observe(time.perf_counter() - g.metrics_start_time)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
@@ -0,0 +1,46 @@
+from typing import Callable, Dict, List, Tuple
+
+
+class RegistrationBroadcaster:
+    """Sends register_broadcast to the room of a registration session.
+
+    With an interval greater than 0, registrations of a session arriving within one interval are merged into a single
+    event. Every event carries the registration round and a list of [seq, name] pairs, so clients can put deltas from
+    several workers in order and drop deltas of a round that has been reset meanwhile.
+    """
+
+    def __init__(self, socketio, namespace: str, room: Callable[[str], str], interval: float):
+        self.socketio = socketio
+        self.namespace = namespace
+        self.room = room
+        self.interval = interval
+        self._pending: Dict[Tuple[str, str], List[Tuple[int, str]]] = {}
+        self._task = None
+
+    def add(self, session_id: str, registration_round: str, seq: int, name: str):
+        if self.interval <= 0:
+            self._emit(session_id, registration_round, [(seq, name)])
+            return
+        self._pending.setdefault((session_id, registration_round), []).append((seq, name))
+        if self._task is None:
+            self._task = self.socketio.start_background_task(self._run)
+
+    def clear(self, session_id: str):
+        """Drops pending registrations of a session, used when its registration is reset."""
+        for key in [key for key in self._pending if key[0] == session_id]:
+            del self._pending[key]
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            if not self._pending:
+                continue
+            pending, self._pending = self._pending, {}
+            for (session_id, registration_round), registrations in pending.items():
+                self._emit(session_id, registration_round, sorted(registrations))
+
+    def _emit(self, session_id: str, registration_round: str, registrations: List[Tuple[int, str]]):
+        self.socketio.emit('register_broadcast',
+                           {'round': registration_round,
+                            'registrations': registrations},
+                           room=self.room(session_id), namespace=self.namespace)
@@ -0,0 +1,57 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class RegistrationStore:
+    """Registrations of the current voting, to be used while holding vote_registration_lock."""
+
+    def __init__(self):
+        self._userids: Set[str] = set()
+        self._fullnames: List[str] = []
+        # Socket the token of a registered user is sent to, by user id
+        self._sessionids: Dict[str, str] = {}
+        self._fullnames_snapshot: Optional[Tuple[str, ...]] = None
+        # Incremented on every registration, so clients can detect missed register_broadcast deltas
+        self.seq = 0
+
+    def __len__(self):
+        return len(self._fullnames)
+
+    def contains_userid(self, userid: str) -> bool:
+        return userid in self._userids
+
+    def add(self, userid: str, fullname: str, sessionid: str) -> Optional[int]:
+        """Registers a user and returns the new sequence number or None if the user is already registered."""
+        if userid in self._userids:
+            return None
+        self._userids.add(userid)
+        self._fullnames.append(fullname)
+        self._sessionids[userid] = sessionid
+        self._fullnames_snapshot = None
+        self.seq += 1
+        return self.seq
+
+    def fullnames(self) -> Tuple[str, ...]:
+        """Immutable view of the registered names that can be handed to emit outside of the lock."""
+        if self._fullnames_snapshot is None:
+            self._fullnames_snapshot = tuple(self._fullnames)
+        return self._fullnames_snapshot
+
+    def rebind(self, userid: str, sessionid: str) -> bool:
+        """Moves the registration of a user to a new socket, returns False if the user has no pending registration."""
+        if userid not in self._sessionids:
+            return False
+        self._sessionids[userid] = sessionid
+        return True
+
+    def take_sessions(self) -> List[Tuple[str, str]]:
+        """Returns (userid, sessionid) of all registered users and forgets the sessions, names and userids are kept."""
+        sessions = list(self._sessionids.items())
+        self._sessionids = {}
+        return sessions
+
+    def clear(self):
+        self._userids.clear()
+        self._fullnames.clear()
+        self._sessionids.clear()
+        self._fullnames_snapshot = None
+        self.seq = 0
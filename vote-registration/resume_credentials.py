@@ -0,0 +1,28 @@
+from typing import Optional
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from state_backend import SamlReturnData
+
+
+class ResumeCredentials:
+    """Signed credentials that let a reconnecting socket continue its session without a new SAML login.
+
+    A credential contains the SAML data of the user and is valid for max_age seconds. Clients exchange it for a fresh
+    one while they are connected, so only sockets disconnected for longer have to log in again.
+    """
+
+    def __init__(self, secret_key: str, max_age: float):
+        self.max_age = max_age
+        self._serializer = URLSafeTimedSerializer(secret_key, salt='resume')
+
+    def issue(self, saml_return_data: SamlReturnData) -> str:
+        return self._serializer.dumps(saml_return_data.to_json())
+
+    def load(self, credential: str) -> Optional[SamlReturnData]:
+        try:
+            data = self._serializer.loads(credential, max_age=self.max_age)
+        except BadSignature:
+            # Includes SignatureExpired
+            return None
+        return SamlReturnData.from_json(data)
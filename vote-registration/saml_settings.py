@@ -0,0 +1,72 @@
+import hashlib
+import os
+import time
+from threading import Lock
+from typing import List, Tuple
+
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+
+
+class SamlSettingsCache:
+    """Loads the SAML settings and certificates once instead of on every request.
+
+    If reload_interval is greater than 0, the files are checked for modifications at most once per interval and the
+    settings are reloaded if any of them changed. The SP metadata is rendered and validated on every (re)load.
+    """
+
+    def __init__(self, base_path: str, reload_interval: float = 0):
+        self.base_path = base_path
+        self.reload_interval = reload_interval
+        self._lock = Lock()
+        self._last_check = 0.0
+        self._signature = None
+        self._settings = None
+        self._metadata: Tuple[bytes, str, List[str]] = (b'', '', [])
+
+    def _watched_files(self) -> List[str]:
+        files = [os.path.join(self.base_path, 'settings.json'),
+                 os.path.join(self.base_path, 'advanced_settings.json')]
+        certs_path = os.path.join(self.base_path, 'certs')
+        if os.path.isdir(certs_path):
+            files.extend(os.path.join(certs_path, name) for name in sorted(os.listdir(certs_path)))
+        return files
+
+    def _files_signature(self):
+        signature = []
+        for filename in self._watched_files():
+            try:
+                stat = os.stat(filename)
+                signature.append((filename, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((filename, None, None))
+        return tuple(signature)
+
+    def _load(self, signature):
+        settings = OneLogin_Saml2_Settings(custom_base_path=self.base_path)
+        sp_metadata = settings.get_sp_metadata()
+        if isinstance(sp_metadata, str):
+            sp_metadata = sp_metadata.encode('utf-8')
+        errors = settings.validate_metadata(sp_metadata)
+        self._metadata = (sp_metadata, hashlib.sha256(sp_metadata).hexdigest(), errors)
+        self._settings = settings
+        self._signature = signature
+
+    def get(self) -> OneLogin_Saml2_Settings:
+        now = time.monotonic()
+        if self._settings is not None and (self.reload_interval <= 0 or now - self._last_check < self.reload_interval):
+            return self._settings
+        with self._lock:
+            if self._settings is None or now - self._last_check >= self.reload_interval > 0:
+                self._last_check = now
+                signature = self._files_signature()
+                if signature != self._signature:
+                    self._load(signature)
+            return self._settings
+
+    def local_mode(self) -> bool:
+        return self.get().get_security_data().get('localMode', False)
+
+    def sp_metadata(self) -> Tuple[bytes, str, List[str]]:
+        """Returns the rendered SP metadata, its ETag and the validation errors."""
+        self.get()
+        return self._metadata
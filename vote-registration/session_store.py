@@ -0,0 +1,63 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+class LoginSessionStore(Generic[T]):
+    """Login tokens waiting for their socket to connect.
+
+    Tokens expire after ttl seconds. If more than max_size tokens are pending, the oldest ones are dropped and a warning
+    is logged, None keeps all of them until they expire. Entries are kept in insertion order, so expired entries are
+    always at the front and pruning is amortized O(1).
+    """
+
+    def __init__(self, ttl: float, max_size: Optional[int]):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        # Number of entries dropped before they expired
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prune(self, now: float):
+        while self._entries:
+            token, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                if self.max_size is None or len(self._entries) <= self.max_size:
+                    break
+                self.dropped += 1
+                # Logged once per max_size drops, so a flood of entries does not flood the log as well
+                if (self.dropped - 1) % self.max_size == 0:
+                    logger.warning("More than %d entries pending, dropped %d so far", self.max_size, self.dropped)
+            del self._entries[token]
+
+    def put(self, token: str, value: T):
+        now = time.monotonic()
+        self._entries.pop(token, None)
+        self._entries[token] = (now + self.ttl, value)
+        self._prune(now)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, token: str) -> Optional[T]:
+        entry = self._entries.get(token)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def pop(self, token: str) -> Optional[T]:
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            return None
+        return value
@@ -0,0 +1,458 @@
+import json
+import secrets
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from metrics import InstrumentedLock
+from registration_store import RegistrationStore
+from session_store import LoginSessionStore
+
+
+# Page a socket was opened from
+ROLE_VOTER = 'voter'
+ROLE_ADMIN = 'admin'
+ROLE_PRESENTER = 'presenter'
+ROLES = (ROLE_VOTER, ROLE_ADMIN, ROLE_PRESENTER)
+
+# Registration session used if none is given in the URL
+DEFAULT_REGISTRATION_SESSION = 'default'
+
+
+class SamlReturnData:
+    votingStatus = False
+    adminStatus = False
+    presenterStatus = False
+    userid = ""
+    fullname = ""
+    role = ROLE_VOTER
+    registration_session = DEFAULT_REGISTRATION_SESSION
+
+    def to_json(self) -> str:
+        return json.dumps({'votingStatus': self.votingStatus,
+                           'adminStatus': self.adminStatus,
+                           'presenterStatus': self.presenterStatus,
+                           'userid': self.userid,
+                           'fullname': self.fullname,
+                           'role': self.role,
+                           'registration_session': self.registration_session})
+
+    @staticmethod
+    def from_json(data) -> 'SamlReturnData':
+        saml_return_data = SamlReturnData()
+        for key, value in json.loads(data).items():
+            setattr(saml_return_data, key, value)
+        return saml_return_data
+
+
+def new_registration_round() -> str:
+    return secrets.token_hex(8)
+
+
+class RegistrationStatus:
+    def __init__(self, registration_active: bool, voting_title: str, registered_fullnames: Sequence[str],
+                 registration_seq: int, registration_round: str):
+        self.registration_active = registration_active
+        self.voting_title = voting_title
+        self.registered_fullnames = registered_fullnames
+        self.registration_seq = registration_seq
+        # Changes with every start of the registration, sequence numbers are only comparable within a round
+        self.registration_round = registration_round
+
+
+class EndedRegistration:
+    def __init__(self, sessions: List[Tuple[str, str]], registered_fullnames: Sequence[str], voting_link: str,
+                 registration_round: str, registration_seq: int):
+        # (userid, sessionid) of every registered user
+        self.sessions = sessions
+        self.registered_fullnames = registered_fullnames
+        self.voting_link = voting_link
+        self.registration_round = registration_round
+        # Sequence number of the last registration, so clients notice a missed delta
+        self.registration_seq = registration_seq
+
+
+class StateBackend:
+    """Holds all state shared between the requests and socket events of vote-registration.
+
+    Registrations are kept per registration session, so independent groups can vote at the same time.
+    """
+
+    def store_login_session(self, token: str, saml_return_data: SamlReturnData):
+        raise NotImplementedError
+
+    def pop_login_session(self, token: str) -> Optional[SamlReturnData]:
+        raise NotImplementedError
+
+    def store_socket_session(self, sid: str, saml_return_data: SamlReturnData):
+        raise NotImplementedError
+
+    def get_socket_session(self, sid: str) -> Optional[SamlReturnData]:
+        raise NotImplementedError
+
+    def remove_socket_session(self, sid: str):
+        """Forgets a disconnected socket including its roles, its registration is kept."""
+        raise NotImplementedError
+
+    def add_admin(self, sid: str):
+        raise NotImplementedError
+
+    def is_admin(self, sid: str) -> bool:
+        raise NotImplementedError
+
+    def get_registration_status(self, session_id: str) -> RegistrationStatus:
+        raise NotImplementedError
+
+    def is_registered(self, session_id: str, userid: str) -> bool:
+        raise NotImplementedError
+
+    def register(self, session_id: str, userid: str, fullname: str, sid: str) -> Optional[Tuple[str, int]]:
+        """Registers a user if the registration is active and returns round and sequence number, None otherwise."""
+        raise NotImplementedError
+
+    def rebind_registration(self, session_id: str, userid: str, sid: str) -> bool:
+        """Sends the token of a registered user to a new socket, returns False if there is no active registration."""
+        raise NotImplementedError
+
+    def store_pending_token(self, session_id: str, userid: str, token: str, voting_link: str):
+        """Keeps an issued token until its client acknowledged it, so it can be sent again on resume."""
+        raise NotImplementedError
+
+    def get_pending_token(self, session_id: str, userid: str) -> Optional[Tuple[str, str]]:
+        """Returns the unacknowledged token and voting link of a user."""
+        raise NotImplementedError
+
+    def ack_pending_token(self, session_id: str, userid: str, token: str):
+        """Forgets the pending token of a user, unless it has been replaced by a token of a later registration."""
+        raise NotImplementedError
+
+    def start_registration(self, session_id: str, voting_title: Optional[str] = None,
+                           voting_link: Optional[str] = None) -> str:
+        """Clears all registrations and pending tokens, activates the registration and returns its new round.
+
+        Title and link are kept if they are None.
+        """
+        raise NotImplementedError
+
+    def end_registration(self, session_id: str) -> Optional[EndedRegistration]:
+        """Deactivates the registration and returns the registered sessions, None if it was not active."""
+        raise NotImplementedError
+
+
+class VoteRegistrationData:
+    """State of one registration session with its own lock."""
+    registration_active = False
+    registration_round = ""
+    voting_title = ""
+    voting_link = ""
+
+    def __init__(self, pending_token_ttl: float):
+        self.registrations = RegistrationStore()
+        # At most one token per registered user, so they are not capped and only expire
+        self.pending_tokens = LoginSessionStore(pending_token_ttl, None)
+        self.lock = InstrumentedLock(Lock())
+
+
+class InProcessStateBackend(StateBackend):
+    """Default backend keeping the state in this process, so it only supports a single worker."""
+
+    def __init__(self, login_session_ttl: float = 300, max_login_sessions: int = 10000,
+                 pending_token_ttl: float = 600):
+        self.login_sessions = LoginSessionStore(login_session_ttl, max_login_sessions)
+        self.pending_token_ttl = pending_token_ttl
+        self.socket_sessions = {}
+        self.admins = set()
+        # Registration sessions are created by start_registration and only guarded by their own lock afterwards
+        self.vote_registrations: Dict[str, VoteRegistrationData] = {}
+        self.vote_registrations_lock = Lock()
+
+    def store_login_session(self, token, saml_return_data):
+        self.login_sessions.put(token, saml_return_data)
+
+    def pop_login_session(self, token):
+        return self.login_sessions.pop(token)
+
+    def store_socket_session(self, sid, saml_return_data):
+        self.socket_sessions[sid] = saml_return_data
+
+    def get_socket_session(self, sid):
+        return self.socket_sessions.get(sid)
+
+    def remove_socket_session(self, sid):
+        self.socket_sessions.pop(sid, None)
+        self.admins.discard(sid)
+
+    def add_admin(self, sid):
+        self.admins.add(sid)
+
+    def is_admin(self, sid):
+        return sid in self.admins
+
+    def get_registration_status(self, session_id):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return RegistrationStatus(False, "", (), 0, "")
+        with data.lock:
+            return RegistrationStatus(data.registration_active, data.voting_title, data.registrations.fullnames(),
+                                      data.registrations.seq, data.registration_round)
+
+    def is_registered(self, session_id, userid):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return False
+        with data.lock:
+            return data.registrations.contains_userid(userid)
+
+    def register(self, session_id, userid, fullname, sid):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return None
+        with data.lock:
+            if not data.registration_active:
+                return None
+            seq = data.registrations.add(userid, fullname, sid)
+            return None if seq is None else (data.registration_round, seq)
+
+    def rebind_registration(self, session_id, userid, sid):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return False
+        with data.lock:
+            return data.registration_active and data.registrations.rebind(userid, sid)
+
+    def store_pending_token(self, session_id, userid, token, voting_link):
+        data = self.vote_registrations.get(session_id)
+        if data is not None:
+            data.pending_tokens.put(userid, (token, voting_link))
+
+    def get_pending_token(self, session_id, userid):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return None
+        return data.pending_tokens.get(userid)
+
+    def ack_pending_token(self, session_id, userid, token):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return
+        with data.lock:
+            pending_token = data.pending_tokens.get(userid)
+            if pending_token is not None and pending_token[0] == token:
+                data.pending_tokens.pop(userid)
+
+    def start_registration(self, session_id, voting_title=None, voting_link=None):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            with self.vote_registrations_lock:
+                data = self.vote_registrations.setdefault(
+                    session_id, VoteRegistrationData(self.pending_token_ttl))
+        with data.lock:
+            data.registration_active = True
+            data.registration_round = new_registration_round()
+            data.registrations.clear()
+            data.pending_tokens.clear()
+            if voting_title is not None:
+                data.voting_title = voting_title
+            if voting_link is not None:
+                data.voting_link = voting_link
+            return data.registration_round
+
+    def end_registration(self, session_id):
+        data = self.vote_registrations.get(session_id)
+        if data is None:
+            return None
+        with data.lock:
+            if not data.registration_active:
+                return None
+            data.registration_active = False
+            return EndedRegistration(data.registrations.take_sessions(), data.registrations.fullnames(),
+                                     data.voting_link, data.registration_round, data.registrations.seq)
+
+
+_REGISTER_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= '1' then
+    return nil
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 0 then
+    return nil
+end
+redis.call('RPUSH', KEYS[3], ARGV[2])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+return {redis.call('GET', KEYS[6]), redis.call('INCR', KEYS[5])}
+"""
+
+_END_REGISTRATION_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= '1' then
+    return nil
+end
+redis.call('SET', KEYS[1], '0')
+local sessions = redis.call('HGETALL', KEYS[2])
+redis.call('DEL', KEYS[2])
+local fullnames = redis.call('LRANGE', KEYS[3], 0, -1)
+local voting_link = redis.call('GET', KEYS[4]) or ''
+return {sessions, fullnames, voting_link, redis.call('GET', KEYS[5]), redis.call('GET', KEYS[6]) or '0'}
+"""
+
+_REBIND_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= '1' or redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+class RedisStateBackend(StateBackend):
+    """Keeps the state in Redis, so several worker processes can serve the same voting.
+
+    Registration and ending the registration run as Lua scripts and are therefore atomic across workers.
+    """
+
+    def __init__(self, client, prefix: str = 'secret-voting:', login_session_ttl: float = 300,
+                 pending_token_ttl: float = 600):
+        self.client = client
+        self.prefix = prefix
+        self.login_session_ttl = login_session_ttl
+        self.pending_token_ttl = pending_token_ttl
+        self._register_script = client.register_script(_REGISTER_SCRIPT)
+        self._end_registration_script = client.register_script(_END_REGISTRATION_SCRIPT)
+        self._rebind_script = client.register_script(_REBIND_SCRIPT)
+
+    @staticmethod
+    def from_url(url: str, login_session_ttl: float = 300, pending_token_ttl: float = 600) -> 'RedisStateBackend':
+        import redis
+        return RedisStateBackend(redis.Redis.from_url(url, decode_responses=True),
+                                 login_session_ttl=login_session_ttl, pending_token_ttl=pending_token_ttl)
+
+    def _key(self, name: str) -> str:
+        return self.prefix + name
+
+    def _session_key(self, session_id: str, name: str) -> str:
+        return '{}session:{}:{}'.format(self.prefix, session_id, name)
+
+    def _registration_keys(self, session_id: str) -> Tuple[str, str, str, str, str, str]:
+        return (self._session_key(session_id, 'registration_active'),
+                self._session_key(session_id, 'registered_userids'),
+                self._session_key(session_id, 'registered_fullnames'),
+                self._session_key(session_id, 'registered_sessions'),
+                self._session_key(session_id, 'registration_seq'),
+                self._session_key(session_id, 'registration_round'))
+
+    def store_login_session(self, token, saml_return_data):
+        # Redis expires unclaimed tokens, so no cap on their number is needed
+        self.client.set(self._key('login:' + token), saml_return_data.to_json(),
+                        ex=max(1, int(self.login_session_ttl)))
+
+    def pop_login_session(self, token):
+        pipe = self.client.pipeline()
+        pipe.get(self._key('login:' + token))
+        pipe.delete(self._key('login:' + token))
+        # The pipeline runs as a transaction, so only one worker can consume the token
+        data, _ = pipe.execute()
+        if data is None:
+            return None
+        return SamlReturnData.from_json(data)
+
+    def store_socket_session(self, sid, saml_return_data):
+        self.client.hset(self._key('socket_sessions'), sid, saml_return_data.to_json())
+
+    def get_socket_session(self, sid):
+        data = self.client.hget(self._key('socket_sessions'), sid)
+        if data is None:
+            return None
+        return SamlReturnData.from_json(data)
+
+    def remove_socket_session(self, sid):
+        pipe = self.client.pipeline()
+        pipe.hdel(self._key('socket_sessions'), sid)
+        pipe.srem(self._key('admins'), sid)
+        pipe.execute()
+
+    def add_admin(self, sid):
+        self.client.sadd(self._key('admins'), sid)
+
+    def is_admin(self, sid):
+        return bool(self.client.sismember(self._key('admins'), sid))
+
+    def get_registration_status(self, session_id):
+        active_key, _, fullnames_key, _, seq_key, round_key = self._registration_keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.get(active_key)
+        pipe.get(self._session_key(session_id, 'voting_title'))
+        pipe.lrange(fullnames_key, 0, -1)
+        pipe.get(seq_key)
+        pipe.get(round_key)
+        active, voting_title, fullnames, seq, registration_round = pipe.execute()
+        return RegistrationStatus(active == '1', voting_title or '', fullnames, int(seq or 0), registration_round or '')
+
+    def is_registered(self, session_id, userid):
+        return bool(self.client.sismember(self._session_key(session_id, 'registered_userids'), userid))
+
+    def register(self, session_id, userid, fullname, sid):
+        result = self._register_script(keys=self._registration_keys(session_id), args=[userid, fullname, sid])
+        if result is None:
+            return None
+        registration_round, seq = result
+        return registration_round, int(seq)
+
+    def rebind_registration(self, session_id, userid, sid):
+        active_key, _, _, sessions_key, _, _ = self._registration_keys(session_id)
+        return bool(self._rebind_script(keys=[active_key, sessions_key], args=[userid, sid]))
+
+    def store_pending_token(self, session_id, userid, token, voting_link):
+        pending_tokens_key = self._session_key(session_id, 'pending_tokens')
+        pipe = self.client.pipeline()
+        pipe.hset(pending_tokens_key, userid, json.dumps([token, voting_link]))
+        pipe.expire(pending_tokens_key, max(1, int(self.pending_token_ttl)))
+        pipe.execute()
+
+    def get_pending_token(self, session_id, userid):
+        data = self.client.hget(self._session_key(session_id, 'pending_tokens'), userid)
+        if data is None:
+            return None
+        token, voting_link = json.loads(data)
+        return token, voting_link
+
+    def ack_pending_token(self, session_id, userid, token):
+        pending_tokens_key = self._session_key(session_id, 'pending_tokens')
+
+        def delete_unchanged(pipe):
+            data = pipe.hget(pending_tokens_key, userid)
+            if data is not None and json.loads(data)[0] == token:
+                pipe.multi()
+                pipe.hdel(pending_tokens_key, userid)
+
+        self.client.transaction(delete_unchanged, pending_tokens_key)
+
+    def start_registration(self, session_id, voting_title=None, voting_link=None):
+        active_key, userids_key, fullnames_key, sessions_key, seq_key, round_key = self._registration_keys(session_id)
+        registration_round = new_registration_round()
+        pipe = self.client.pipeline()
+        pipe.delete(userids_key, fullnames_key, sessions_key, seq_key,
+                    self._session_key(session_id, 'pending_tokens'))
+        if voting_title is not None:
+            pipe.set(self._session_key(session_id, 'voting_title'), voting_title)
+        if voting_link is not None:
+            pipe.set(self._session_key(session_id, 'voting_link'), voting_link)
+        pipe.set(round_key, registration_round)
+        pipe.set(active_key, '1')
+        pipe.execute()
+        return registration_round
+
+    def end_registration(self, session_id):
+        active_key, _, fullnames_key, sessions_key, seq_key, round_key = self._registration_keys(session_id)
+        result = self._end_registration_script(
+            keys=[active_key, sessions_key, fullnames_key, self._session_key(session_id, 'voting_link'), round_key,
+                  seq_key])
+        if result is None:
+            return None
+        sessions, fullnames, voting_link, registration_round, seq = result
+        # HGETALL returns the fields and values alternately
+        return EndedRegistration(list(zip(sessions[::2], sessions[1::2])), fullnames, voting_link,
+                                 registration_round, int(seq))
+
+
+def create_state_backend(url: Optional[str], login_session_ttl: float = 300, max_login_sessions: int = 10000,
+                         pending_token_ttl: float = 600) -> StateBackend:
+    if url:
+        return RedisStateBackend.from_url(url, login_session_ttl, pending_token_ttl)
+    return InProcessStateBackend(login_session_ttl, max_login_sessions, pending_token_ttl)
@@ -10,8 +10,47 @@ $(document).ready(function () {
         socket = io(namespace, {query: "token=" + secret_voting_token});
     }
 
+    // The login token can only be used once, reconnect with the last resume credential instead
+    socket.on('reconnect_attempt', function () {
+        if (resumeCredential !== null) {
+            socket.io.opts.query = "resume=" + encodeURIComponent(resumeCredential);
+            socket.query = socket.io.opts.query;
+        }
+    });
+
+    socket.on('resume_credential', function (msg) {
+        resumeCredential = msg.resume;
+    });
+
     socket.on('register_broadcast', function (msg) {
-        updateListOfUsers(msg.registered_fullnames)
+        if (msg.round !== registrationRound) {
+            // Sent before a reset, the sequence numbers belong to the previous registration
+            return;
+        }
+        for (const [seq, name] of msg.registrations) {
+            // Smaller sequence numbers are already contained in the last snapshot
+            if (seq > registrationSeq) {
+                pendingRegistrations[seq] = name;
+            }
+        }
+        while ((registrationSeq + 1) in pendingRegistrations) {
+            let seq = registrationSeq + 1;
+            addToListOfUsers(pendingRegistrations[seq], seq);
+            delete pendingRegistrations[seq];
+        }
+        if (Object.keys(pendingRegistrations).length > 0 && resyncTimer === null) {
+            // Deltas from another server process may still be on their way, wait before fetching the full list
+            resyncTimer = setTimeout(function () {
+                resyncTimer = null;
+                if (Object.keys(pendingRegistrations).length > 0) {
+                    socket.emit('registration_resync', {});
+                }
+            }, 1000);
+        }
+    });
+
+    socket.on('registration_snapshot', function (msg) {
+        updateListOfUsers(msg.registered_fullnames, msg.round, msg.seq);
     });
 
     socket.on('register_response', function (msg) {
@@ -24,7 +63,8 @@ $(document).ready(function () {
     });
 
     socket.on('reset_broadcast', function (msg) {
-        updateListOfUsers([])
+        updateListOfUsers([], msg.round, 0);
+        $('#ballot_box_activation_state').text('');
         $("#register_success").html('');
         $("#your_token").val('');
         $('#voting_title').html(msg.voting_title);
@@ -35,11 +75,15 @@ $(document).ready(function () {
     });
 
     socket.on('voting_end_broadcast', function (msg) {
+        if (msg.round === registrationRound && msg.seq > registrationSeq) {
+            // Registrations are final now, fetch the ones whose deltas did not arrive
+            socket.emit('registration_resync', {});
+        }
         setControlState(true);
         setState(false);
     });
 
-    socket.on('generated_token', function (msg) {
+    socket.on('generated_token', function (msg, ack) {
         let yourToken = $('#your_token');
         yourToken.val(msg.token);
 
@@ -59,10 +103,12 @@ $(document).ready(function () {
         copyBtn.prop("disabled", false);
 
         $('#register_btn').prop("disabled", true);
+        // The server keeps the token for a resumed session until it is acknowledged
+        ack();
     });
 
     socket.on('initial_status', function (msg) {
-        updateListOfUsers(msg.registered_fullnames);
+        updateListOfUsers(msg.registered_fullnames, msg.registration_round, msg.registration_seq);
 
         setState(msg.registration_active);
         if (msg.registration_active && !msg.already_registered) {
@@ -73,6 +119,15 @@ $(document).ready(function () {
         $('#voting_title').html(msg.voting_title);
         $("#fullname").val(msg.fullname);
         $("#connection_state").html("Connected");
+        resumeCredential = msg.resume;
+        if (resumeRefreshTimer === null) {
+            // Refresh the credential well before it expires
+            resumeRefreshTimer = setInterval(function () {
+                if (socket.connected) {
+                    socket.emit('resume_refresh', {});
+                }
+            }, msg.resume_ttl * 1000 / 2);
+        }
         if (msg.admin_state) {
             $("#admin_state").html("true");
         } else {
@@ -111,6 +166,11 @@ $(document).ready(function () {
         copyBtn.prop("disabled", false);
     });
 
+    socket.on('ballot_box_activation_response', function (msg) {
+        let activationState = $('#ballot_box_activation_state');
+        activationState.text(activationState.data(msg.successful ? 'successful' : 'failed') + ' (' + msg.poll_id + ')');
+    });
+
     // User controls
     $('form#voting_register').submit(function (event) {
         socket.emit('voting_register', {});
@@ -145,11 +205,34 @@ function setControlState(registrationDisabled) {
     $("#voting_end :input").prop('disabled', registrationDisabled);
 }
 
-function updateListOfUsers(all_users) {
+// Round of the registration the list of users belongs to, changes on every reset
+let registrationRound = null;
+// Sequence number of the last registration contained in the list of users
+let registrationSeq = 0;
+let numOfUsers = 0;
+// Registrations received before one with a smaller sequence number, by sequence number
+let pendingRegistrations = {};
+let resyncTimer = null;
+// Signed credential to continue the session after a reconnect without logging in again
+let resumeCredential = null;
+let resumeRefreshTimer = null;
+
+function updateListOfUsers(all_users, round, seq) {
     let list_contents = "";
     for (name of all_users) {
         list_contents += '<li>' + name + '</li>\n';
     }
     $("#list_of_users").html(list_contents);
-    $("#num_of_users").html(all_users.length);
+    numOfUsers = all_users.length;
+    $("#num_of_users").html(numOfUsers);
+    registrationRound = round;
+    registrationSeq = seq;
+    pendingRegistrations = {};
+}
+
+function addToListOfUsers(name, seq) {
+    $("#list_of_users").append('<li>' + name + '</li>\n');
+    numOfUsers += 1;
+    $("#num_of_users").html(numOfUsers);
+    registrationSeq = seq;
 }
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Fingerprinted and precompressed static files.
+
+`python static_assets.py static` copies the assets in static/ to static/assets/ with a content hash in their name,
+writes gzip (and brotli, if the module is installed) versions next to them and a manifest mapping the original names
+to the fingerprinted ones. Templates link assets with asset_url(), which falls back to the plain static files if the
+build step has not been run.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+
+from flask import Flask, abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSETS_DIRECTORY = 'assets'
+MANIFEST_FILE = 'manifest.json'
+ASSET_EXTENSIONS = ('.css', '.js', '.svg')
+# Content-Encoding and file suffix of the precompressed variants, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# The name changes with the content, so clients never need to revalidate
+MAX_AGE = 31536000
+
+
+def build(static_folder: str):
+    assets_folder = os.path.join(static_folder, ASSETS_DIRECTORY)
+    shutil.rmtree(assets_folder, ignore_errors=True)
+    os.makedirs(assets_folder)
+    manifest = {}
+    for name in sorted(os.listdir(static_folder)):
+        root, extension = os.path.splitext(name)
+        if extension not in ASSET_EXTENSIONS or not os.path.isfile(os.path.join(static_folder, name)):
+            continue
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            data = f.read()
+        fingerprinted_name = '{}.{}{}'.format(root, hashlib.sha256(data).hexdigest()[:12], extension)
+        _write(os.path.join(assets_folder, fingerprinted_name), data)
+        _write(os.path.join(assets_folder, fingerprinted_name + '.gz'), gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            _write(os.path.join(assets_folder, fingerprinted_name + '.br'), brotli.compress(data))
+        manifest[name] = fingerprinted_name
+    with open(os.path.join(assets_folder, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def _write(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class StaticAssets:
+    """Serves the built assets at /assets/ with Cache-Control: immutable and the best precompressed variant."""
+
+    def __init__(self, app: Flask):
+        self.folder = os.path.join(app.static_folder, ASSETS_DIRECTORY)
+        try:
+            with open(os.path.join(self.folder, MANIFEST_FILE)) as f:
+                self.manifest = json.load(f)
+        except OSError:
+            self.manifest = {}
+        # Encodings available per fingerprinted name, checked once instead of on every request
+        self.encodings = {name: [(encoding, suffix) for encoding, suffix in ENCODINGS
+                                 if os.path.isfile(os.path.join(self.folder, name + suffix))]
+                          for name in self.manifest.values()}
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send_asset)
+        app.add_template_global(self.url, 'asset_url')
+
+    def url(self, filename: str) -> str:
+        if filename in self.manifest:
+            return url_for('assets', filename=self.manifest[filename])
+        return url_for('static', filename=filename)
+
+    def send_asset(self, filename: str):
+        if filename not in self.encodings:
+            abort(404)
+        for encoding, suffix in self.encodings[filename]:
+            if request.accept_encodings[encoding]:
+                response = send_from_directory(self.folder, filename + suffix, cache_timeout=MAX_AGE,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.folder, filename, cache_timeout=MAX_AGE)
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(MAX_AGE)
+        return response
+
+
+if __name__ == '__main__':
+    for folder in sys.argv[1:] or ['static']:
+        for original, fingerprinted in build(folder).items():
+            print('{} -> {}'.format(original, fingerprinted))
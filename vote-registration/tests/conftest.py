@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import sys
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_backend import InProcessStateBackend, RedisStateBackend  # noqa: E402
+
+NAMESPACE = '/test'
+TOKEN_PATTERN = re.compile(r'secret_voting_token = "([^"]+)"')
+
+
+@pytest.fixture
+def redis_workers():
+    """Two Redis backends sharing one in-process Redis server, like two gunicorn workers."""
+    server = fakeredis.FakeServer()
+    return [RedisStateBackend(fakeredis.FakeStrictRedis(server=server, decode_responses=True)) for _ in range(2)]
+
+
+@pytest.fixture(params=['in_process', 'redis'])
+def state_backend(request):
+    """A fresh state backend of every kind."""
+    if request.param == 'redis':
+        return RedisStateBackend(fakeredis.FakeStrictRedis(server=fakeredis.FakeServer(), decode_responses=True))
+    return InProcessStateBackend()
+
+
+@pytest.fixture(scope='session')
+def registration_app(tmp_path_factory):
+    """The app module with the SAML settings of the template in local mode."""
+    os.environ['REGISTER_BROADCAST_INTERVAL_MS'] = '0'
+    import app
+    from saml_settings import SamlSettingsCache
+    settings_path = tmp_path_factory.mktemp('saml')
+    with open(os.path.join(app.SAML_CONFIG_DIRECTORY, 'settings.json.tpl')) as f:
+        settings = f.read().replace('[application-url]', 'localhost').replace('[idp-url]', 'idp.localhost')
+    settings = json.loads(settings)
+    settings['security']['localMode'] = True
+    with open(str(settings_path / 'settings.json'), 'w') as f:
+        json.dump(settings, f)
+    app.saml_settings = SamlSettingsCache(str(settings_path))
+    return app
+
+
+@pytest.fixture
+def registration(registration_app, monkeypatch):
+    """Test client of vote-registration with a fresh in-process state backend."""
+    monkeypatch.setattr(registration_app, 'state', InProcessStateBackend())
+    return RegistrationClient(registration_app)
+
+
+class RegistrationClient:
+    NAMESPACE = NAMESPACE
+
+    def __init__(self, app):
+        self.app = app
+        self.http = app.app.test_client()
+
+    def login(self, userid, fullname=None, admin=False, session='default', role='voter', presenter=False):
+        form = {'userid': userid, 'fullname': fullname or 'User ' + userid, 'is_voting': 'on',
+                'RelayState': '{}:{}'.format(role, session)}
+        if admin:
+            form['is_admin'] = 'on'
+        if presenter:
+            form['is_presenter'] = 'on'
+        return TOKEN_PATTERN.search(self.http.post('/', data=form).get_data(as_text=True)).group(1)
+
+    def connect(self, query):
+        return self.app.socketio.test_client(self.app.app, namespace=NAMESPACE, query_string=query,
+                                             flask_test_client=self.http)
+
+    def voter(self, userid, session='default'):
+        return self.connect('token=' + self.login(userid, session=session))
+
+    def admin(self, session='default'):
+        return self.connect('token=' + self.login('admin-' + session, admin=True, session=session, role='admin'))
+
+    def presenter(self, session='default'):
+        return self.connect('token=' + self.login('presenter-' + session, presenter=True, session=session,
+                                                  role='presenter'))
+
+
+def close(socket):
+    """Disconnects like a closed browser tab, the test client alone keeps the engine.io session and its queues."""
+    socket.disconnect(NAMESPACE)
+    socket.socketio.server._handle_eio_disconnect(socket.sid)
+    socket.queue.pop(socket.sid, None)
+    socket.acks.pop(socket.sid, None)
+
+
+def acknowledge(socket):
+    """Acknowledges the events the socket received with a callback, the test client does not keep their ids."""
+    manager = socket.socketio.server.manager
+    for ack_id in [ack_id for ack_id in manager.callbacks.get(socket.sid, {}).get(NAMESPACE, {}) if ack_id != 0]:
+        manager.trigger_callback(socket.sid, NAMESPACE, ack_id, [])
+
+
+def received(socket, name):
+    """Arguments of the events with the given name that the socket received since the last call."""
+    return [message['args'][0] for message in socket.get_received(NAMESPACE) if message['name'] == name]
@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+import urllib.error
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from ballot_box_client import BallotBoxClient
+from conftest import received
+
+NAMESPACE = '/test'
+
+
+class BallotBoxHandler(BaseHTTPRequestHandler):
+    """Answers the activation API like ballot-box and records the requests."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                break
+        body = b''.join(chunks)
+        self.server.requests.append((self.path, dict(self.headers), [chunk for chunk in chunks if chunk], body))
+        status, response = self.server.response
+        if status == 200:
+            rows = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+            response = dict(response, tokens=sum('token' in row for row in rows),
+                            attendees=sum('attendee' in row for row in rows))
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def ballot_box():
+    server = HTTPServer(('127.0.0.1', 0), BallotBoxHandler)
+    server.requests = []
+    server.response = (200, {'poll_id': '7'})
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def api_url(server):
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def test_poll_ids_are_only_taken_from_links_of_the_ballot_box():
+    client = BallotBoxClient('https://ballot-box.example.org/', 'secret')
+    assert client.poll_id_for('https://ballot-box.example.org/7') == '7'
+    assert client.poll_id_for('https://ballot-box.example.org/7/') == '7'
+    assert client.poll_id_for('https://ballot-box.example.org/admin') is None
+    assert client.poll_id_for('https://ballot-box.example.org.evil/7') is None
+    assert client.poll_id_for('https://other.example.org/7') is None
+
+
+def test_tokens_and_attendees_are_pushed_in_chunks(ballot_box):
+    client = BallotBoxClient('https://ballot-box.example.org', 'secret', api_url(ballot_box), lines_per_chunk=2)
+    response = client.activate_poll('7', ['a', 'b', 'c'], ['Zoë'])
+    assert response == {'poll_id': '7', 'tokens': 3, 'attendees': 1}
+    [(path, headers, chunks, body)] = ballot_box.requests
+    assert path == '/api/activate_poll/7'
+    assert headers['Authorization'] == 'Bearer secret'
+    assert headers['Transfer-Encoding'] == 'chunked' and 'Content-Length' not in headers
+    assert len(chunks) == 2
+    assert [json.loads(line) for line in body.decode('utf-8').splitlines()] == \
+        [{'token': 'a'}, {'token': 'b'}, {'token': 'c'}, {'attendee': 'Zoë'}]
+
+
+def test_refused_activation_raises(ballot_box):
+    ballot_box.response = (409, {'error': 'poll_not_prepared'})
+    client = BallotBoxClient('https://ballot-box.example.org', 'secret', api_url(ballot_box))
+    with pytest.raises(urllib.error.HTTPError) as error:
+        client.activate_poll('7', ['a'], [])
+    assert error.value.code == 409
+
+
+def wait_for_activation(admin):
+    """Messages of the admin until ballot-box answered, the poll is activated in a background task."""
+    messages = []
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        messages += admin.get_received(NAMESPACE)
+        if any(message['name'] == 'ballot_box_activation_response' for message in messages):
+            break
+        time.sleep(0.01)
+    return {message['name']: message['args'][0] for message in messages}
+
+
+@pytest.mark.parametrize('status', [200, 400])
+def test_poll_is_activated_when_the_registration_ends(registration, ballot_box, monkeypatch, status):
+    ballot_box.response = (status, {'poll_id': '7'} if status == 200 else {'error': 'Duplicate token'})
+    monkeypatch.setattr(registration.app, 'ballot_box_client',
+                        BallotBoxClient('https://ballot-box.example.org', 'secret', api_url(ballot_box)))
+    admin = registration.admin()
+    admin.emit('admin_voting_start', {'voting_title': 'Title', 'voting_link': 'https://ballot-box.example.org/7'},
+               namespace=NAMESPACE)
+    voter = registration.voter('a')
+    voter.emit('voting_register', {}, namespace=NAMESPACE)
+    admin.get_received(NAMESPACE)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    messages = wait_for_activation(admin)
+    assert messages['ballot_box_activation_response'] == {'successful': status == 200, 'poll_id': '7'}
+    tokens = messages['voting_end_response']['all_tokens']
+    [(_, _, _, body)] = ballot_box.requests
+    assert [json.loads(line) for line in body.decode('utf-8').splitlines()] == \
+        [{'token': token} for token in tokens] + [{'attendee': 'User a'}]
+
+
+def test_other_voting_links_are_not_activated(registration, ballot_box, monkeypatch):
+    monkeypatch.setattr(registration.app, 'ballot_box_client',
+                        BallotBoxClient('https://ballot-box.example.org', 'secret', api_url(ballot_box)))
+    admin = registration.admin()
+    admin.emit('admin_voting_start', {'voting_title': 'Title', 'voting_link': 'https://elsewhere.example.org/7'},
+               namespace=NAMESPACE)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    assert received(admin, 'ballot_box_activation_response') == []
+    assert ballot_box.requests == []
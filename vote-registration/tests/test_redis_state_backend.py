@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from state_backend import SamlReturnData
+
+SESSION = 'default'
+
+
+def saml_data(userid):
+    data = SamlReturnData()
+    data.userid = userid
+    data.fullname = 'User ' + userid
+    data.votingStatus = True
+    return data
+
+
+def test_registration_is_shared_between_workers(redis_workers):
+    first, second = redis_workers
+    registration_round = first.start_registration(SESSION, 'Title', 'http://ballot-box/1')
+    assert second.register(SESSION, 'a', 'User a', 'sid-a') == (registration_round, 1)
+    assert first.register(SESSION, 'b', 'User b', 'sid-b') == (registration_round, 2)
+    for worker in redis_workers:
+        status = worker.get_registration_status(SESSION)
+        assert status.registration_active
+        assert status.registration_round == registration_round
+        assert status.voting_title == 'Title'
+        assert list(status.registered_fullnames) == ['User a', 'User b']
+        assert status.registration_seq == 2
+        assert worker.is_registered(SESSION, 'a') and worker.is_registered(SESSION, 'b')
+
+
+def test_user_is_registered_once_across_workers(redis_workers):
+    first, second = redis_workers
+    registration_round = first.start_registration(SESSION)
+    assert first.register(SESSION, 'a', 'User a', 'sid-1') == (registration_round, 1)
+    assert second.register(SESSION, 'a', 'User a', 'sid-2') is None
+    assert list(second.get_registration_status(SESSION).registered_fullnames) == ['User a']
+
+
+def test_concurrent_registrations_get_unique_sequence_numbers(redis_workers):
+    redis_workers[0].start_registration(SESSION)
+
+    def register(i):
+        # Every user tries to register on both workers, only one attempt may succeed
+        return [worker.register(SESSION, 'user{}'.format(i), 'User {}'.format(i), 'sid{}'.format(i))
+                for worker in redis_workers]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(register, range(200)))
+    seqs = [registration[1] for attempts in results for registration in attempts if registration is not None]
+    assert sorted(seqs) == list(range(1, 201))
+    assert all(sum(registration is not None for registration in attempts) == 1 for attempts in results)
+    assert len(redis_workers[1].get_registration_status(SESSION).registered_fullnames) == 200
+
+
+def test_registration_needs_active_registration(redis_workers):
+    first, second = redis_workers
+    assert second.register(SESSION, 'a', 'User a', 'sid-a') is None
+    first.start_registration(SESSION)
+    first.end_registration(SESSION)
+    assert second.register(SESSION, 'a', 'User a', 'sid-a') is None
+
+
+def test_registration_ends_once_with_sessions_of_both_workers(redis_workers):
+    first, second = redis_workers
+    registration_round = first.start_registration(SESSION, 'Title', 'http://ballot-box/1')
+    first.register(SESSION, 'a', 'User a', 'sid-a')
+    second.register(SESSION, 'b', 'User b', 'sid-b')
+    assert second.rebind_registration(SESSION, 'a', 'sid-a2')
+    ended = first.end_registration(SESSION)
+    assert sorted(ended.sessions) == [('a', 'sid-a2'), ('b', 'sid-b')]
+    assert list(ended.registered_fullnames) == ['User a', 'User b']
+    assert ended.voting_link == 'http://ballot-box/1'
+    assert (ended.registration_round, ended.registration_seq) == (registration_round, 2)
+    assert second.end_registration(SESSION) is None
+    assert not second.get_registration_status(SESSION).registration_active
+    assert not first.rebind_registration(SESSION, 'a', 'sid-a3')
+
+
+def test_rebind_needs_existing_registration(redis_workers):
+    first, second = redis_workers
+    first.start_registration(SESSION)
+    assert not second.rebind_registration(SESSION, 'a', 'sid-a')
+
+
+def test_start_registration_resets_for_all_workers(redis_workers):
+    first, second = redis_workers
+    old_round = first.start_registration(SESSION, 'Old', 'http://ballot-box/1')
+    first.register(SESSION, 'a', 'User a', 'sid-a')
+    new_round = second.start_registration(SESSION, 'New')
+    assert new_round != old_round
+    status = first.get_registration_status(SESSION)
+    assert status.registration_round == new_round
+    assert list(status.registered_fullnames) == []
+    assert status.registration_seq == 0
+    assert status.voting_title == 'New'
+    assert not first.is_registered(SESSION, 'a')
+    assert first.register(SESSION, 'a', 'User a', 'sid-a') == (new_round, 1)
+
+
+def test_login_token_is_consumed_by_one_worker(redis_workers):
+    first, second = redis_workers
+    first.store_login_session('token', saml_data('a'))
+    assert second.pop_login_session('token').userid == 'a'
+    assert first.pop_login_session('token') is None
+
+
+def test_socket_sessions_and_admins_are_shared(redis_workers):
+    first, second = redis_workers
+    first.store_socket_session('sid-a', saml_data('a'))
+    first.add_admin('sid-a')
+    assert second.get_socket_session('sid-a').fullname == 'User a'
+    assert second.is_admin('sid-a')
+    second.remove_socket_session('sid-a')
+    assert first.get_socket_session('sid-a') is None
+    assert not first.is_admin('sid-a')
+
+
+def test_pending_token_is_kept_until_acknowledged(redis_workers):
+    first, second = redis_workers
+    first.start_registration(SESSION)
+    first.store_pending_token(SESSION, 'a', 'TOKEN', 'http://ballot-box/1')
+    assert second.get_pending_token(SESSION, 'a') == ('TOKEN', 'http://ballot-box/1')
+    assert first.get_pending_token(SESSION, 'a') == ('TOKEN', 'http://ballot-box/1')
+    second.ack_pending_token(SESSION, 'a', 'TOKEN')
+    assert first.get_pending_token(SESSION, 'a') is None
@@ -0,0 +1,36 @@
+from conftest import received
+
+NAMESPACE = '/test'
+
+
+def test_deltas_carry_the_round_of_their_registration(registration):
+    admin = registration.admin()
+    voter = registration.voter('a')
+    admin.emit('admin_voting_start', {'voting_title': 'First', 'voting_link': 'http://ballot-box/1'},
+               namespace=NAMESPACE)
+    first_round = received(voter, 'reset_broadcast')[0]['round']
+    voter.emit('voting_register', {}, namespace=NAMESPACE)
+    assert received(admin, 'register_broadcast') == [{'round': first_round, 'registrations': [(1, 'User a')]}]
+
+    admin.emit('admin_voting_reset', {}, namespace=NAMESPACE)
+    second_round = received(voter, 'reset_broadcast')[0]['round']
+    assert second_round != first_round
+    # A delta of the first round arriving now must not be confused with the first registration of the second one
+    voter.emit('voting_register', {}, namespace=NAMESPACE)
+    assert received(admin, 'register_broadcast') == [{'round': second_round, 'registrations': [(1, 'User a')]}]
+
+    late_voter = registration.voter('b')
+    status = received(late_voter, 'initial_status')[0]
+    assert (status['registration_round'], status['registration_seq']) == (second_round, 1)
+
+
+def test_voting_end_carries_the_final_sequence_number(registration):
+    admin = registration.admin()
+    voters = [registration.voter(userid) for userid in 'abc']
+    admin.emit('admin_voting_start', {'voting_title': 'Title', 'voting_link': 'http://ballot-box/1'},
+               namespace=NAMESPACE)
+    registration_round = received(admin, 'reset_broadcast')[0]['round']
+    for voter in voters:
+        voter.emit('voting_register', {}, namespace=NAMESPACE)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    assert received(admin, 'voting_end_broadcast') == [{'round': registration_round, 'seq': 3}]
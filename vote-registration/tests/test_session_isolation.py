@@ -0,0 +1,149 @@
+import threading
+
+from conftest import received
+
+NAMESPACE = '/test'
+
+
+def test_reset_and_end_only_change_their_own_session(state_backend):
+    state_backend.start_registration('first', 'First', 'http://ballot-box/1')
+    state_backend.start_registration('second', 'Second', 'http://ballot-box/2')
+    state_backend.register('first', 'a', 'User a', 'sid-a1')
+    state_backend.register('second', 'a', 'User a', 'sid-a2')
+    state_backend.register('second', 'b', 'User b', 'sid-b2')
+
+    state_backend.start_registration('first')
+    status = state_backend.get_registration_status('second')
+    assert list(status.registered_fullnames) == ['User a', 'User b']
+    assert status.registration_seq == 2 and status.voting_title == 'Second'
+    assert state_backend.is_registered('second', 'a') and not state_backend.is_registered('first', 'a')
+
+    state_backend.register('first', 'c', 'User c', 'sid-c1')
+    ended = state_backend.end_registration('second')
+    assert sorted(ended.sessions) == [('a', 'sid-a2'), ('b', 'sid-b2')]
+    assert ended.voting_link == 'http://ballot-box/2'
+    state_backend.store_pending_token('second', 'a', 'TOKEN', ended.voting_link)
+    first = state_backend.get_registration_status('first')
+    assert first.registration_active and list(first.registered_fullnames) == ['User c']
+    assert state_backend.get_pending_token('first', 'a') is None
+
+    # Restarting the first session keeps the pending tokens of the second one
+    state_backend.start_registration('first')
+    assert state_backend.get_pending_token('second', 'a') == ('TOKEN', 'http://ballot-box/2')
+    ended = state_backend.end_registration('first')
+    assert ended.sessions == [] and ended.voting_link == 'http://ballot-box/1'
+    assert not state_backend.get_registration_status('second').registration_active
+
+
+def test_broadcasts_and_tokens_stay_in_their_session(registration, state_backend, monkeypatch):
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    admins = {session: registration.admin(session) for session in ('first', 'second')}
+    voters = {session: [registration.voter('{}-{}'.format(session, i), session) for i in range(3)]
+              for session in ('first', 'second')}
+    for session, admin in admins.items():
+        admin.emit('admin_voting_start', {'voting_title': session, 'voting_link': 'http://ballot-box/' + session},
+                   namespace=NAMESPACE)
+    for session_voters in voters.values():
+        for voter in session_voters:
+            voter.emit('voting_register', {}, namespace=NAMESPACE)
+    for session, session_voters in voters.items():
+        for voter in session_voters:
+            messages = voter.get_received(NAMESPACE)
+            assert [message['args'][0]['voting_title'] for message in messages
+                    if message['name'] == 'reset_broadcast'] == [session]
+            assert sum(message['name'] == 'register_broadcast' for message in messages) == 3
+    for admin in admins.values():
+        admin.get_received(NAMESPACE)
+
+    admins['first'].emit('admin_voting_reset', {}, namespace=NAMESPACE)
+    assert all(len(received(voter, 'reset_broadcast')) == 1 for voter in voters['first'])
+    assert all(received(voter, 'reset_broadcast') == [] for voter in voters['second'])
+    assert received(admins['second'], 'reset_broadcast') == []
+
+    admins['second'].emit('admin_voting_end', {}, namespace=NAMESPACE)
+    tokens = received(admins['second'], 'voting_end_response')[0]['all_tokens']
+    assert len(tokens) == 3
+    assert sorted(received(voter, 'generated_token')[0]['token'] for voter in voters['second']) == tokens
+    for voter in voters['first']:
+        assert not {'voting_end_broadcast', 'generated_token'} & {message['name']
+                                                                  for message in voter.get_received(NAMESPACE)}
+    status = state_backend.get_registration_status('first')
+    assert status.registration_active and list(status.registered_fullnames) == []
+
+
+def test_concurrent_sessions_stay_isolated(registration, state_backend, monkeypatch):
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    sessions = ['session{}'.format(i) for i in range(32)]
+    # Sessions of different sizes, so events delivered to the wrong session change the counts
+    admins = {session: registration.admin(session) for session in sessions}
+    voters = {session: [registration.voter('{}-{}'.format(session, j), session) for j in range(1 + i % 4)]
+              for i, session in enumerate(sessions)}
+    barrier = threading.Barrier(len(sessions))
+    errors = []
+
+    def run(session):
+        try:
+            barrier.wait(10)
+            admins[session].emit('admin_voting_start', {'voting_title': session, 'voting_link': 'http://' + session},
+                                 namespace=NAMESPACE)
+            for voter in voters[session]:
+                voter.emit('voting_register', {}, namespace=NAMESPACE)
+            admins[session].emit('admin_voting_end', {}, namespace=NAMESPACE)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(session,)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert errors == []
+
+    for session in sessions:
+        names = sorted('User {}-{}'.format(session, j) for j in range(len(voters[session])))
+        messages = admins[session].get_received(NAMESPACE)
+        end_response = [message['args'][0] for message in messages if message['name'] == 'voting_end_response']
+        assert [sorted(response['all_users']) for response in end_response] == [names]
+        tokens = end_response[0]['all_tokens']
+        assert len(tokens) == len(names)
+        registrations = [registration for message in messages if message['name'] == 'register_broadcast'
+                         for registration in message['args'][0]['registrations']]
+        assert sorted(name for _, name in registrations) == names
+        assert sorted(seq for seq, _ in registrations) == list(range(1, len(names) + 1))
+        voter_tokens = []
+        for voter in voters[session]:
+            messages = voter.get_received(NAMESPACE)
+            assert [message['args'][0]['voting_title'] for message in messages
+                    if message['name'] == 'reset_broadcast'] == [session]
+            assert sorted(name for message in messages if message['name'] == 'register_broadcast'
+                          for _, name in message['args'][0]['registrations']) == names
+            voter_tokens += [message['args'][0]['token'] for message in messages
+                             if message['name'] == 'generated_token']
+        # Every voter got exactly one token, and it is one of its own session
+        assert sorted(voter_tokens) == tokens
+        assert state_backend.get_registration_status(session).registration_seq == len(names)
+
+
+def test_registration_events_are_emitted_once_per_session(registration, monkeypatch):
+    server = registration.app.socketio.server
+    emitted = []
+    server_emit = server.emit
+
+    def counting_emit(event, *args, **kwargs):
+        emitted.append(event)
+        return server_emit(event, *args, **kwargs)
+
+    monkeypatch.setattr(server, 'emit', counting_emit)
+    admin = registration.admin()
+    presenter = registration.presenter()
+    voter = registration.voter('a')
+    admin.emit('admin_voting_start', {'voting_title': 'Title', 'voting_link': 'http://ballot-box/1'},
+               namespace=NAMESPACE)
+    voter.emit('voting_register', {}, namespace=NAMESPACE)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    events = ('reset_broadcast', 'register_broadcast', 'voting_end_broadcast')
+    assert [event for event in emitted if event in events] == list(events)
+    # Still rendered by every page
+    for socket in (admin, presenter, voter):
+        assert [message['name'] for message in socket.get_received(NAMESPACE) if message['name'] in events] == \
+            list(events)
@@ -0,0 +1,74 @@
+import gc
+
+from conftest import close
+from state_backend import InProcessStateBackend, SamlReturnData
+
+CYCLES = 100000
+
+
+def saml_data(userid, admin=False):
+    data = SamlReturnData()
+    data.userid = userid
+    data.fullname = 'User ' + userid
+    data.votingStatus = True
+    data.adminStatus = admin
+    return data
+
+
+def test_unclaimed_login_tokens_are_capped():
+    backend = InProcessStateBackend(max_login_sessions=100)
+    for i in range(1000):
+        backend.store_login_session('token{}'.format(i), saml_data(str(i)))
+    assert len(backend.login_sessions) == 100
+    assert backend.pop_login_session('token0') is None
+    assert backend.pop_login_session('token999').userid == '999'
+
+
+def test_unclaimed_login_tokens_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('session_store.time.monotonic', lambda: now[0])
+    backend = InProcessStateBackend(login_session_ttl=300)
+    backend.store_login_session('old', saml_data('old'))
+    now[0] += 301
+    backend.store_login_session('new', saml_data('new'))
+    assert len(backend.login_sessions) == 1
+    assert backend.pop_login_session('old') is None
+    assert backend.pop_login_session('new').userid == 'new'
+
+
+def test_memory_stays_flat_across_login_connect_disconnect_cycles(registration, monkeypatch):
+    """Every cycle logs in, connects and disconnects a socket, every tenth login is abandoned."""
+    state = InProcessStateBackend(max_login_sessions=1000)
+    monkeypatch.setattr(registration.app, 'state', state)
+    object_counts = []
+    for i in range(CYCLES):
+        # What acs stores for a login
+        state.store_login_session('token{}'.format(i), saml_data('user{}'.format(i % 5000), admin=i % 20 == 0))
+        if i % 10:
+            socket = registration.connect('token=token{}'.format(i))
+            assert socket.is_connected(registration.NAMESPACE)
+            close(socket)
+        if i + 1 in (CYCLES // 10, CYCLES):
+            gc.collect()
+            object_counts.append(len(gc.get_objects()))
+    assert state.socket_sessions == {}
+    assert state.admins == set()
+    assert len(state.login_sessions) <= 1000
+    # The first checkpoint is taken once the abandoned logins reached the cap
+    assert object_counts[1] - object_counts[0] < 1000, object_counts
+
+
+def test_redis_keys_stay_flat_across_login_connect_disconnect_cycles(redis_workers):
+    """Logins are claimed by one worker and the socket is cleaned up by the other one.
+
+    Fewer cycles than in-process, as fakeredis is much slower and keeps nothing in Python that could leak.
+    """
+    first, second = redis_workers
+    for i in range(CYCLES // 10):
+        first.store_login_session('token{}'.format(i), saml_data('user{}'.format(i % 5000), admin=i % 20 == 0))
+        data = second.pop_login_session('token{}'.format(i))
+        second.store_socket_session('sid{}'.format(i), data)
+        if data.adminStatus:
+            second.add_admin('sid{}'.format(i))
+        first.remove_socket_session('sid{}'.format(i))
+    assert first.client.dbsize() == 0
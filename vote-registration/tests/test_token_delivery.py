@@ -0,0 +1,117 @@
+from urllib.parse import quote
+
+from conftest import acknowledge, close, received
+from state_backend import InProcessStateBackend
+
+NAMESPACE = '/test'
+VOTERS = 200
+
+
+def start_registration(registration):
+    admin = registration.admin()
+    admin.emit('admin_voting_start', {'voting_title': 'Title', 'voting_link': 'http://ballot-box/1'},
+               namespace=NAMESPACE)
+    return admin
+
+
+def register(registration, userid):
+    """Connects and registers a voter, returns the socket and its resume credential."""
+    voter = registration.voter(userid)
+    credential = received(voter, 'initial_status')[0]['resume']
+    voter.emit('voting_register', {}, namespace=NAMESPACE)
+    return voter, credential
+
+
+def resume(registration, credential):
+    voter = registration.connect('resume=' + quote(credential))
+    assert voter.is_connected(NAMESPACE)
+    return voter
+
+
+def test_unacknowledged_tokens_are_sent_again_after_a_mass_reconnect(registration, state_backend, monkeypatch):
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    admin = start_registration(registration)
+    voters = [register(registration, 'user{}'.format(i)) for i in range(VOTERS)]
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    tokens = [received(voter, 'generated_token')[0]['token'] for voter, _ in voters]
+    # The connections of every second voter died while the token was on its way, the sockets still looked connected
+    for voter, _ in voters[1::2]:
+        close(voter)
+    for voter, _ in voters[::2]:
+        acknowledge(voter)
+        # Disconnected by the server once the token arrived
+        assert state_backend.get_socket_session(voter.sid) is None
+    assert sorted(tokens) == sorted(received(admin, 'voting_end_response')[0]['all_tokens'])
+
+    for i, (_, credential) in enumerate(voters):
+        voter = resume(registration, credential)
+        if i % 2:
+            assert received(voter, 'generated_token') == [{'token': tokens[i], 'voting_link': 'http://ballot-box/1'}]
+            acknowledge(voter)
+        else:
+            assert received(voter, 'generated_token') == []
+            close(voter)
+    # Acknowledged on resume, so another reconnect does not repeat them
+    for _, credential in voters[1::2]:
+        voter = resume(registration, credential)
+        assert received(voter, 'generated_token') == []
+        close(voter)
+
+
+def test_voters_disconnected_at_the_end_get_their_token_on_resume(registration, state_backend, monkeypatch):
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    admin = start_registration(registration)
+    voters = [register(registration, 'user{}'.format(i)) for i in range(VOTERS)]
+    for voter, _ in voters:
+        close(voter)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    all_tokens = received(admin, 'voting_end_response')[0]['all_tokens']
+    tokens = set()
+    for _, credential in voters:
+        voter = resume(registration, credential)
+        [message] = received(voter, 'generated_token')
+        tokens.add(message['token'])
+        acknowledge(voter)
+    assert sorted(tokens) == all_tokens
+
+
+def test_acknowledgements_after_the_admin_left_are_handled(registration, state_backend, monkeypatch):
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    admin = start_registration(registration)
+    voters = [register(registration, 'user{}'.format(i))[0] for i in range(10)]
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    # The admin reloads the page while the tokens are on their way
+    close(admin)
+    for i, voter in enumerate(voters):
+        acknowledge(voter)
+        assert state_backend.get_pending_token('default', 'user{}'.format(i)) is None
+        assert state_backend.get_socket_session(voter.sid) is None
+
+
+def test_late_acknowledgement_keeps_the_token_of_a_new_registration(state_backend):
+    state_backend.start_registration('default', 'Title', 'http://ballot-box/1')
+    state_backend.store_pending_token('default', 'a', 'old', 'http://ballot-box/1')
+    state_backend.start_registration('default')
+    state_backend.store_pending_token('default', 'a', 'new', 'http://ballot-box/1')
+    state_backend.ack_pending_token('default', 'a', 'old')
+    assert state_backend.get_pending_token('default', 'a') == ('new', 'http://ballot-box/1')
+    state_backend.ack_pending_token('default', 'a', 'new')
+    assert state_backend.get_pending_token('default', 'a') is None
+
+
+def test_pending_tokens_are_not_capped_by_the_login_sessions(registration, monkeypatch, caplog):
+    state_backend = InProcessStateBackend(max_login_sessions=5)
+    monkeypatch.setattr(registration.app, 'state', state_backend)
+    admin = start_registration(registration)
+    voters = [register(registration, 'user{}'.format(i)) for i in range(20)]
+    for voter, _ in voters:
+        close(voter)
+    admin.emit('admin_voting_end', {}, namespace=NAMESPACE)
+    assert all(state_backend.get_pending_token('default', 'user{}'.format(i)) for i in range(20))
+    assert not caplog.records
+
+    # Login tokens beyond the cap are dropped, but not silently
+    for i in range(6):
+        state_backend.store_login_session('login{}'.format(i), None)
+    assert state_backend.login_sessions.pop('login0') is None
+    assert [record.levelname for record in caplog.records] == ['WARNING']